@@ -1,3 +1,26 @@
-from .api import get_example
-from .execution import execute
-from . import api_use_tasks
+"""The API use benchmark.
+
+Submodules are imported on first use, so that e.g. a scoring worker importing
+`api_use.execution_utils` does not pay for prompt generation or the bundled
+libraries. See `api_use.import_budget` for the cold start budgets.
+"""
+
+import importlib
+
+_LAZY_ATTRIBUTES = {
+  'get_example': ('.api', 'get_example'),
+  'execute': ('.execution', 'execute'),
+}
+
+def __getattr__(name):
+  if name in _LAZY_ATTRIBUTES:
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    value = getattr(importlib.import_module(module_name, __name__), attribute)
+  else:
+    try:
+      value = importlib.import_module(f'.{name}', __name__)
+    except ModuleNotFoundError as e:
+      if e.name != f'{__name__}.{name}': raise
+      raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+  globals()[name] = value
+  return value
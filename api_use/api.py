@@ -1,24 +1,30 @@
 import ast
 from collections import Counter, defaultdict
+import dataclasses
 from dataclasses import dataclass
+import functools
 from functools import partial
+import hashlib
+import json
 import random
+import re
 import sys
-from typing import Any, Callable, Dict, List, Optional, Set, Union
-from typing_extensions import Literal
+from typing import AbstractSet, Any, Callable, Dict, Iterable, List, Literal, Optional, Set, Tuple, Union
 
 from . import task
+from . import testspec
+from . import tokens
 from . import utils
 
 @dataclass
 class TaskIdCallData:
-  distractor_funcs : Optional[Set[task.Function]] = None
+  distractor_funcs : Optional[AbstractSet[task.Function]] = None
   target_funcs : Optional[Set[task.Function]] = None
   count : int = 0
 
-  def intersect_distractor_funcs(self, new_distractor_funcs : Set[task.Function]):
+  def intersect_distractor_funcs(self, new_distractor_funcs : AbstractSet[task.Function]):
     if self.distractor_funcs is not None:
-      self.distractor_funcs = self.distractor_funcs.intersection(new_distractor_funcs)
+      self.distractor_funcs = frozenset(self.distractor_funcs & new_distractor_funcs)
     else:
       self.distractor_funcs = new_distractor_funcs
 
@@ -37,7 +43,17 @@ class TaskIdCallData:
 class TestCase:
   prompt : str
   target: str
-  test: str
+  test: testspec.TestSpec
+
+@dataclass(frozen=True, eq=False)
+class ShotBlock:
+  """A few-shot example, rendered once and shared by every prompt that shows it.
+
+  `text` is what the example adds to a prompt, and `task_id_to_data` holds the
+  functions it calls, per library. Blocks are cached, so neither is mutated.
+  """
+  text : str
+  task_id_to_data : Dict[str, TaskIdCallData]
 
 def create_preamble(task_id, unspecified_params):
   task_ = task.APITask.get_task(task_id)
@@ -48,83 +64,112 @@ def create_preamble(task_id, unspecified_params):
     preamble = f"" #{task_.library_name} = {task_id.capitalize()}()\n"
     return preamble, [task_.library_name] + unspecified_params, task_.library_name
 
+def parse_signature(signature : str) -> ast.Call:
+  """Parses a signature. The parser recurses once per call, so the recursion limit is raised for deep chains."""
+  limit = sys.getrecursionlimit()
+  sys.setrecursionlimit(max(limit, 4 * signature.count('(') + 1000))
+  try:
+    return ast.parse(signature).body[0].value # type: ignore
+  finally:
+    sys.setrecursionlimit(limit)
+
+def handle_arg(nd):
+  if isinstance(nd, ast.Str):
+    return True, '"' + nd.s + '"'
+  elif isinstance(nd, ast.Num):
+    return True, str(nd.n)
+  elif isinstance(nd, ast.Name):
+    return False, nd.id
+  else:
+    print(ast.dump(nd))
+    assert False
+
 def handle_data(data : ast.Call):
+  """Compiles a signature's call expression into its target and the data needed to prompt for it.
+
+  Chains are flattened and compiled iteratively, so their depth is not bounded
+  by the recursion limit: each chain is a generator that yields the calls
+  nested in its arguments, and a stack of generators runs them in the same
+  order a recursive walk would (which fixes the numbering of dummy values).
+  """
   unfixed_params: Dict[str, str] = {} # from dummy value to global parameter
 
   task_id_to_data : Dict[str, TaskIdCallData] = defaultdict(TaskIdCallData)
   global_target : str = ""
 
-  def handle_node(node : ast.Call):
+  def compile_chain(node : ast.Call):
     nonlocal global_target
     assert isinstance(node, ast.Call)
 
-    value = node.func.value # type: ignore
-    if isinstance(value, ast.Name):
-      parent_id = value.id
-      task_ = task.APITask.get_task(parent_id)
-      parent_target = task_.library_name
-      global_target = parent_id
-    else:
-      parent_id, parent_target = handle_node(value)
-
+    links = []
+    while isinstance(node, ast.Call):
+      links.append(node)
+      node = node.func.value # type: ignore
+    assert isinstance(node, ast.Name)
+    parent_id = node.id
     task_ = task.APITask.get_task(parent_id)
-    task_id = task_.id
+    segments = [task_.library_name]
+    global_target = parent_id
 
+    for link in reversed(links):
+      task_ = task.APITask.get_task(parent_id)
+      task_id = task_.id
 
-    func_name = node.func.attr # type: ignore
+      func_name = link.func.attr # type: ignore
 
-    def handle_arg(nd):
-      if isinstance(nd, ast.Str):
-        return True, '"' + nd.s + '"'
-      elif isinstance(nd, ast.Num):
-        return True, str(nd.n)
-      elif isinstance(nd, ast.Call):
-        id, target = handle_node(nd)
-        return True, target
-      elif isinstance(nd, ast.Name):
-        return False, nd.id
-      else:
-        print(ast.dump(nd))
-        assert False
-
-    distractor_func_list, target_func = task_.generate_priming(func_name)
-    task_id_to_data[task_id].count += 1
-    task_id_to_data[task_id].intersect_distractor_funcs(set(distractor_func_list))
-    task_id_to_data[task_id].add_target_func(target_func)
-
-    all_args = target_func.args
-    signature_kws = [kw.arg for kw in node.keywords]
-    assert len(signature_kws) == len(set(node.keywords)), "Duplicate keywords in function call."
-    assert len(set(signature_kws) - set(all_args)) == 0, f"""Parameter listed in function call
-{[kw.arg for kw in node.keywords]} does not appear in the arguments for function
-{target_func.name}, which are {all_args}!"""
+      distractor_funcs, target_func = task_.generate_priming(func_name)
+      task_id_to_data[task_id].count += 1
+      task_id_to_data[task_id].intersect_distractor_funcs(distractor_funcs)
+      task_id_to_data[task_id].add_target_func(target_func)
 
-    local_arglist = {}
+      all_args = target_func.args
+      signature_kws = [kw.arg for kw in link.keywords]
+      assert len(signature_kws) == len(set(link.keywords)), "Duplicate keywords in function call."
+      assert len(set(signature_kws) - set(all_args)) == 0, f"""Parameter listed in function call
+{[kw.arg for kw in link.keywords]} does not appear in the arguments for function
+{target_func.name}, which are {all_args}!"""
 
-    for arg in all_args:
-      kw = next((kw for kw in node.keywords if kw.arg == arg), None)
-      dummy_val = utils.get_dummy_value(arg)
-      if kw:
-        is_fixed, value = handle_arg(kw.value)
-        if is_fixed:
-          local_arglist[arg] = value
+      local_arglist = []
+      for arg in all_args:
+        kw = next((kw for kw in link.keywords if kw.arg == arg), None)
+        dummy_val = utils.get_dummy_value(arg)
+        if kw:
+          if isinstance(kw.value, ast.Call):
+            is_fixed, value = True, (yield kw.value)[1]
+          else:
+            is_fixed, value = handle_arg(kw.value)
+          if is_fixed:
+            local_arglist.append(value)
+          else:
+            unfixed_params[dummy_val] = value
+            local_arglist.append(dummy_val)
         else:
-          unfixed_params[dummy_val] = value
-          local_arglist[arg] = dummy_val
-      else:
-          unfixed_params[dummy_val] = arg
-          local_arglist[arg] = dummy_val
-
-    local_arglist_str = ', '.join(local_arglist.values())
-    target = f"{parent_target}.{target_func.name}({local_arglist_str})"
-    return target_func.return_type, target
-
-  _, target = handle_node(data)
+            unfixed_params[dummy_val] = arg
+            local_arglist.append(dummy_val)
+
+      segments.append(f".{target_func.name}({', '.join(local_arglist)})")
+      parent_id = target_func.return_type
+    return parent_id, ''.join(segments)
+
+  stack = [compile_chain(data)]
+  result = None
+  while True:
+    try:
+      nested = stack[-1].send(result)
+    except StopIteration as stop:
+      stack.pop()
+      result = stop.value
+      if not stack: break
+    else:
+      stack.append(compile_chain(nested))
+      result = None
+  _, target = result
 
   utils.deduplicate_unfixed_params(unfixed_params)
+  # one pass over the target, rather than one per parameter (dummy values are quoted, so none is a prefix of another)
   human_readable_target = target
-  for dummy_val, arg_name in unfixed_params.items():
-    human_readable_target = human_readable_target.replace(dummy_val, arg_name)
+  if unfixed_params:
+    human_readable_target = re.sub('|'.join(map(re.escape, unfixed_params)), lambda match: unfixed_params[match.group(0)], target)
   #print('tikkk', task_id_to_data)
   return target, {
     'unfixed_params': unfixed_params,
@@ -146,7 +191,7 @@ def format_prompt(*,
                  ):
 
   func_name, outer_arglist = utils.extract_unspecified_arglist_from_func_name(func_name)
-  target, attrs = handle_data(ast.parse(signature).body[0].value) # type: ignore
+  target, attrs = handle_data(parse_signature(signature))
 
   outer_args = list(attrs['unfixed_params'].values())
   global_target = attrs['global_target']
@@ -173,7 +218,12 @@ in both the signature ({outer_arglist}) and `arg_order` argument
 
   test_call = f"{func_name}({dummy_argcall})"
   #print('class_style' if class_style else 'import_style')
-  test = f"# signature = {prefix}\n# indent = '{indent}'\n{global_target} = Dummy()\n# style = '{'class_style' if class_style else 'import_style'}'\nx = {test_call}\ny = $TARGET\nassert x == y, f'Test failure: {{x}} != {{y}}'"
+  test = testspec.TestSpec(signature=prefix,
+                           indent=indent,
+                           dummy_name=global_target,
+                           style='class_style' if class_style else 'import_style',
+                           test_call=test_call,
+                           target_call=target)
 
   instructions = f"""{task_description_preamble}{description}.\n{begin_token}\n{preamble}{prefix}\n{indent}"""
   instructions_completed = f"""{instructions}return {attrs['human_readable_target']}\n{end_token}"""
@@ -189,21 +239,29 @@ in both the signature ({outer_arglist}) and `arg_order` argument
   }
 
 
-def select_distractors(task_id_to_data : Dict[str, TaskIdCallData],
-                                  num_distractors : Union[int, Dict[str, int]],
-                                  target_func_location : Union[int, float, Dict[str, int], Dict[str, float]],
-                                  ):
+def sample_distractors(task_id_to_data : Dict[str, TaskIdCallData],
+                       num_distractors : Union[int, Dict[str, int]],
+                       ) -> Dict[str, List[task.Function]]:
+  """Samples the distractor pool of each library; the only step of distractor selection that uses randomness."""
   if isinstance(num_distractors, int):
     total_library_calls = sum([data.count for data in task_id_to_data.values()])
     distractor_weighting = {task_id: num_distractors * data.count // total_library_calls for task_id, data in task_id_to_data.items()}
   elif isinstance(num_distractors, dict):
     distractor_weighting = num_distractors
 
-  function_pool = []
+  distractor_pools = {}
   for task_id, k in distractor_weighting.items():
     assert k <= len(task_id_to_data[task_id].distractor_funcs), f"{k} distractors requested, but only {len(task_id_to_data[task_id].distractor_funcs)} available"
-    distractor_pool_task_id = random.sample(sorted(task_id_to_data[task_id].distractor_funcs), k=k)
-    target_funcs = list(task_id_to_data[task_id].target_funcs)
+    distractor_pools[task_id] = random.sample(sorted(task_id_to_data[task_id].distractor_funcs), k=k)
+  return distractor_pools
+
+def insert_targets(task_id_to_data : Dict[str, TaskIdCallData],
+                   distractor_pools : Dict[str, List[task.Function]],
+                   target_func_location : Union[int, float, Dict[str, int], Dict[str, float]],
+                   ):
+  function_pool = []
+  for task_id, distractor_pool_task_id in distractor_pools.items():
+    target_funcs = sorted(task_id_to_data[task_id].target_funcs)
     # insert the true functions in each distractor pool
     # [TODO] work on this
     if isinstance(target_func_location, float):
@@ -224,6 +282,107 @@ def select_distractors(task_id_to_data : Dict[str, TaskIdCallData],
 
   return function_pool
 
+def select_distractors(task_id_to_data : Dict[str, TaskIdCallData],
+                                  num_distractors : Union[int, Dict[str, int]],
+                                  target_func_location : Union[int, float, Dict[str, int], Dict[str, float]],
+                                  ):
+  distractor_pools = sample_distractors(task_id_to_data, num_distractors)
+  return insert_targets(task_id_to_data, distractor_pools, target_func_location)
+
+# Suites share a handful of few-shot examples across many cases, so each
+# example is formatted once. An example is keyed by its arguments, defaults
+# included, with lists made hashable; formatting uses no randomness, and the
+# dummy values it consumes never reach its completed instructions.
+def freeze_shot(shot : Dict[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+  return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in shot.items()))
+
+def cached(function, *args):
+  """Calls an lru_cached `function`, or the function itself if an argument is unhashable."""
+  try:
+    hash(args)
+  except TypeError:
+    return function.__wrapped__(*args)
+  return function(*args)
+
+@functools.lru_cache(maxsize=4096)
+def format_shot(shot : Tuple[Tuple[str, Any], ...]) -> ShotBlock:
+  """The completed instructions of a few-shot example, for fewshot_style='combine'."""
+  result = format_prompt(**dict(shot))
+  return ShotBlock(result['instructions_completed'], dict(result['task_id_to_data']))
+
+@functools.lru_cache(maxsize=4096)
+def merge_shots(shots : Tuple[ShotBlock, ...]) -> Dict[str, TaskIdCallData]:
+  """The functions called by any of `shots`, per library."""
+  merged : Dict[str, TaskIdCallData] = defaultdict(TaskIdCallData)
+  for shot in shots:
+    for task_id, data in shot.task_id_to_data.items():
+      merged[task_id].augment_targets(data)
+  return dict(merged)
+
+def stable_seed(*values) -> str:
+  """A digest of `values` that is the same in every process, with callables identified by name."""
+  def default(value):
+    return getattr(value, '__qualname__', None) if callable(value) else repr(value)
+  return hashlib.sha1(json.dumps(values, sort_keys=True, default=default).encode()).hexdigest()
+
+@functools.lru_cache(maxsize=4096)
+def repeat_shot(shot : Tuple[Tuple[str, Any], ...],
+                num_distractors : Union[int, Dict[str, int]],
+                random_seed : Any,
+                intro : str,
+                section_joiner : str,
+                render_args : Tuple[Any, ...],
+                format_function : Optional[Callable[[task.Function], str]] = None) -> ShotBlock:
+  """A few-shot example for fewshot_style='repeat': its own function list, then its completed instructions.
+
+  The list has as many distractors as the main prompt (in total, if they are
+  given per library), sampled under a seed derived from `random_seed` and the
+  example, so that an example reads the same in every prompt that shows it.
+  `render_args` are the (indent, use_quotes, no_description, joiner) of the
+  main function list.
+  """
+  block = format_shot(shot)
+  if isinstance(num_distractors, dict): num_distractors = sum(num_distractors.values())
+  state = random.getstate()
+  random.seed(stable_seed(random_seed, shot))
+  try:
+    distractor_pools = sample_distractors(block.task_id_to_data, num_distractors)
+  finally:
+    random.setstate(state)
+  function_pool = insert_targets(block.task_id_to_data, distractor_pools, -1)
+  indent, use_quotes, no_description, joiner = render_args
+  if format_function:
+    formatted_functions = utils.format_functions(function_pool, format_function, joiner=joiner)
+  else:
+    formatted_functions = utils.render_function_block(tuple(function_pool), indent, use_quotes, no_description, joiner)
+  return ShotBlock(intro + '\n\n' + formatted_functions + section_joiner + block.text, block.task_id_to_data)
+
+BUDGET_POLICIES = Literal['distractors_then_shots', 'shots_then_distractors', 'drop_distractors', 'drop_shots', 'error']
+
+def drop_for_budget(distractor_pools : Dict[str, List[task.Function]],
+                    shots : List[ShotBlock],
+                    budget_policy : BUDGET_POLICIES):
+  """Drops one distractor or few-shot example from an over-budget prompt.
+
+  Distractors are dropped from the end of the largest library's pool, and shots
+  from the start of the prompt (furthest from the problem). Returns None if the
+  policy allows nothing else to be dropped.
+  """
+  order = {
+    'distractors_then_shots': ['distractors', 'shots'],
+    'shots_then_distractors': ['shots', 'distractors'],
+    'drop_distractors': ['distractors'],
+    'drop_shots': ['shots'],
+    'error': [],
+  }[budget_policy]
+  for kind in order:
+    if kind == 'distractors' and any(distractor_pools.values()):
+      task_id = max(distractor_pools, key=lambda task_id: len(distractor_pools[task_id]))
+      return {**distractor_pools, task_id: distractor_pools[task_id][:-1]}, shots
+    elif kind == 'shots' and shots:
+      return distractor_pools, shots[1:]
+  return None
+
 def global_function_name_noising(function_pool, function_noise_type, arg_noise_type, desc_noise_type, target, human_readable_target):
   fname_to_renamed_fname, function_pool = utils.get_fname_mapping(function_pool, function_noise_type, arg_noise_type, desc_noise_type)
   target = utils.replace_keys(target, fname_to_renamed_fname)
@@ -234,9 +393,72 @@ def get_data_for_func_call(
     signature : str,
     description : str,
     *,
-    func_name : str = 'func',
     num_distractors : Union[int, Dict[str, int]] = 0,
     target_func_location : Union[int, float, Dict[str, int], Dict[str, float]] = -1,
+    **kwargs,
+  ):
+  return generate_variants(signature, description, [(num_distractors, [target_func_location])], **kwargs)[0][0]
+
+def get_position_sweep(
+    signature : str,
+    description : str,
+    *,
+    num_distractors_range : Iterable[int],
+    target_func_locations : Optional[Iterable[Union[int, float]]] = None,
+    **kwargs,
+  ) -> Dict[Tuple[int, Union[int, float]], Dict[str, Any]]:
+  """Generates every (num_distractors, target_func_location) variant of a case.
+
+  The prompt is parsed and formatted once, and the distractors are sampled once
+  per distractor count; each variant only inserts the target into the sampled
+  pool and formats the function list. Every variant is identical to the output
+  of `get_data_for_func_call` with the same arguments. If no locations are
+  given, every position in the pool is swept. Any `num_distractors` or
+  `target_func_location` in `kwargs` (e.g. from a base test case) is ignored.
+  """
+  kwargs.pop('num_distractors', None)
+  kwargs.pop('target_func_location', None)
+  variants = [(num_distractors, list(target_func_locations) if target_func_locations is not None else list(range(num_distractors + 1)))
+              for num_distractors in num_distractors_range]
+  results = generate_variants(signature, description, variants, **kwargs)
+  return {(num_distractors, location): result
+          for (num_distractors, locations), variant_results in zip(variants, results)
+          for location, result in zip(locations, variant_results)}
+
+SWEPT_ARGS = ('num_distractors', 'target_func_location')
+
+def get_data_for_test_cases(test_cases : Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+  """Generates a suite of test cases, sharing work between cases that only differ in their distractors.
+
+  Returns the output of `get_data_for_func_call` for every case, in order.
+  """
+  results = {}
+  groups : Dict[str, List[str]] = defaultdict(list)
+  for case_id, case in test_cases.items():
+    if isinstance(case.get('num_distractors', 0), int):
+      groups[json.dumps({k: v for k, v in case.items() if k not in SWEPT_ARGS}, sort_keys=True)].append(case_id)
+    else:
+      results[case_id] = get_data_for_func_call(**case)
+
+  for case_ids in groups.values():
+    base_case = {k: v for k, v in test_cases[case_ids[0]].items() if k not in SWEPT_ARGS}
+    locations : Dict[Any, List[Any]] = defaultdict(list)
+    for case_id in case_ids:
+      case = test_cases[case_id]
+      locations[case.get('num_distractors', 0)].append((case_id, case.get('target_func_location', -1)))
+    variants = [(num_distractors, [location for _, location in cases]) for num_distractors, cases in locations.items()]
+    variant_results = generate_variants(**base_case, variants=variants)
+    for cases, group_results in zip(locations.values(), variant_results):
+      for (case_id, _), result in zip(cases, group_results):
+        results[case_id] = result
+  return {case_id: results[case_id] for case_id in test_cases}
+
+def generate_variants(
+    signature : str,
+    description : str,
+    variants : List[Tuple[Union[int, Dict[str, int]], List[Union[int, float, Dict[str, int], Dict[str, float]]]]],
+    *,
+    func_name : str = 'func',
     arg_order : Optional[Union[List[int], Callable[[List[str]], List[int]]]] = None,
     task_description_preamble : str = "Write a function that ",
     fewshot: List[Dict[Any, Any]] = [],
@@ -252,6 +474,9 @@ def get_data_for_func_call(
     format_function : Optional[Callable[[task.Function], str]] = None,
     begin_token : str = "[BEGIN]",
     random_seed : Any = 229,
+    max_prompt_tokens : Optional[int] = None,
+    tokenizer : tokens.Tokenizer = 'approx',
+    budget_policy : BUDGET_POLICIES = 'distractors_then_shots',
   ):
 
   random.seed(random_seed)
@@ -266,8 +491,6 @@ def get_data_for_func_call(
 
   # implementation: add the fewshot function calls to the list of distractors...
 
-  # support two different fewshot styles: combine all-the-promptings or
-
   # providing default vals for fewshot
   default_vals = {
     'arg_order': arg_order,
@@ -283,43 +506,106 @@ def get_data_for_func_call(
                                     begin_token=begin_token,
                                     indent=indent)
   ## [TODO] Add a test where the default args bleed into fewshot args
-  fewshot_results = [format_prompt(**{**default_vals, **data}) for data in fewshot]
+  shot_keys = [freeze_shot({**default_vals, **data}) for data in fewshot]
 
   def generate_formatted_function_list(function_pool, target, human_readable_target):
     fname_to_renamed_fname, function_pool, target, human_readable_target = global_function_name_noising(function_pool, function_noise_type, arg_noise_type, description_noise_type, target, human_readable_target)
 
-    ff = format_function or partial(utils.default_format_function, indent=indent, use_quotes=use_quotes, no_description=(description_noise_type=='empty'))
-    formatted_function_list = intro + '\n\n' + utils.format_functions(function_pool, ff, joiner=joiner)
-
-    return formatted_function_list, target, human_readable_target
-
+    if format_function:
+      # custom format functions may not be pure, so they are never cached
+      formatted_functions = utils.format_functions(function_pool, format_function, joiner=joiner)
+    else:
+      formatted_functions = utils.render_function_block(tuple(function_pool), indent, use_quotes, description_noise_type == 'empty', joiner)
+    formatted_function_list = intro + '\n\n' + formatted_functions
+
+    return function_pool, formatted_function_list, target, human_readable_target
+
+  def count_prompt_tokens(function_pool, shots):
+    # the sum of the cached counts of the prompt's pieces; see `tokens`
+    render = format_function or partial(utils.render_function, indent=indent, use_quotes=use_quotes, no_description=(description_noise_type=='empty'))
+    return (tokens.count_tokens(intro + '\n\n', tokenizer)
+            + tokens.count_joined((render(func) for func in function_pool), joiner, tokenizer)
+            + tokens.count_tokens(section_joiner, tokenizer)
+            + sum(tokens.count_tokens(shot.text, tokenizer) + tokens.count_tokens(section_joiner, tokenizer) for shot in shots)
+            + tokens.count_tokens(func_call_results['instructions'], tokenizer))
+
+  # `assemble` returns the prompt as segments, so that stores can keep the
+  # pieces shared across prompts (function lists, shots) once each
   if fewshot_style == 'combine':
-    fewshot_instructions_and_answers = section_joiner.join((fewshot_result['instructions_completed'] for fewshot_result in fewshot_results))
-    if fewshot_instructions_and_answers: fewshot_instructions_and_answers += section_joiner
-    for fewshot_result in fewshot_results:
-      for task_id, data in fewshot_result['task_id_to_data'].items():
-        func_call_results['task_id_to_data'][task_id].augment_targets(data)
+    # one function list, with every function the shots call, then the shots and the problem
+    combined_shots = [cached(format_shot, key) for key in shot_keys]
+    for task_id, data in cached(merge_shots, tuple(combined_shots)).items():
+      func_call_results['task_id_to_data'][task_id].augment_targets(data)
       ## [TODO] Add a test where the distractor is from a different library
-    function_pool = select_distractors(task_id_to_data=func_call_results['task_id_to_data'],
-                                       num_distractors=num_distractors,
-                                       target_func_location=target_func_location)
-    formatted_function_list, target, human_readable_target = generate_formatted_function_list(function_pool, func_call_results['target'], func_call_results['human_readable_target'])
-    prompt = formatted_function_list + section_joiner + fewshot_instructions_and_answers + func_call_results['instructions']
-
-  # elif fewshot_style == 'repeat':
-  # not yet implemented
+    def get_shots(num_distractors):
+      return combined_shots
+    def join_shots(shots):
+      fewshot_instructions_and_answers = section_joiner.join(shot.text for shot in shots)
+      if fewshot_instructions_and_answers: fewshot_instructions_and_answers += section_joiner
+      return fewshot_instructions_and_answers
+    def assemble(formatted_function_list, shots):
+      return [formatted_function_list, section_joiner + join_shots(shots) + func_call_results['instructions']]
+
+  elif fewshot_style == 'repeat':
+    # each shot with its own function list, then the problem with its own
+    render_args = (indent, use_quotes, description_noise_type == 'empty', joiner)
+    def get_shots(num_distractors):
+      args = (num_distractors, random_seed, intro, section_joiner, render_args)
+      if format_function:
+        # custom format functions may not be pure, so they are never cached
+        return [repeat_shot.__wrapped__(key, *args, format_function) for key in shot_keys]
+      return [cached(repeat_shot, key, *args) for key in shot_keys]
+    def assemble(formatted_function_list, shots):
+      return [shot.text + section_joiner for shot in shots] + [formatted_function_list, section_joiner + func_call_results['instructions']]
 
   else:
     raise ValueError(f"Fewshot style {fewshot_style} not recognized.")
 
-
-  return {
-    "prompt": prompt,
-    "formatted_function_list": formatted_function_list,
-    "target": human_readable_target,
-    "test": func_call_results['test'].replace('$TARGET', target),
-  }
+  # Each variant must see the random state a fresh call would: sampling starts
+  # from the state after formatting, and noising from the state after sampling.
+  formatted_state = random.getstate()
+  results = []
+  for num_distractors, target_func_locations in variants:
+    random.setstate(formatted_state)
+    distractor_pools = sample_distractors(func_call_results['task_id_to_data'], num_distractors)
+    sampled_state = random.getstate()
+    fewshot_results = get_shots(num_distractors)
+    variant_results = []
+    for target_func_location in target_func_locations:
+      pools, shots = distractor_pools, fewshot_results
+      while True:
+        random.setstate(sampled_state)
+        function_pool = insert_targets(func_call_results['task_id_to_data'], pools, target_func_location)
+        function_pool, formatted_function_list, target, human_readable_target = generate_formatted_function_list(function_pool, func_call_results['target'], func_call_results['human_readable_target'])
+        if max_prompt_tokens is None: break
+        num_prompt_tokens = count_prompt_tokens(function_pool, shots)
+        if num_prompt_tokens <= max_prompt_tokens: break
+        shrunk = drop_for_budget(pools, shots, budget_policy)
+        if shrunk is None:
+          raise ValueError(f"The prompt for {func_call_results['label']} needs {num_prompt_tokens} tokens, "
+                           f"over the budget of {max_prompt_tokens}, with budget_policy={budget_policy}.")
+        pools, shots = shrunk
+      prompt_segments = assemble(formatted_function_list, shots)
+      result = {
+        "prompt": ''.join(prompt_segments),
+        "prompt_segments": prompt_segments,
+        "formatted_function_list": formatted_function_list,
+        "target": human_readable_target,
+        "test": dataclasses.replace(func_call_results['test'], target_call=target),
+      }
+      if max_prompt_tokens is not None:
+        result["num_prompt_tokens"] = num_prompt_tokens
+        result["num_dropped_distractors"] = sum(map(len, distractor_pools.values())) - sum(map(len, pools.values()))
+        result["num_dropped_shots"] = len(fewshot_results) - len(shots)
+      variant_results.append(result)
+    results.append(variant_results)
+  return results
 
 def get_example(*args, return_test_case : bool = True, **kwargs):
   results = get_data_for_func_call(*args, **kwargs)
   return TestCase(prompt=results['prompt'], target='return ' + results['target'], test=results['test'])
+
+def get_examples(test_cases : Dict[str, Dict[str, Any]]) -> Dict[str, TestCase]:
+  """`get_example` for every case of a suite, sharing work across distractor sweeps."""
+  return {case_id: TestCase(prompt=results['prompt'], target='return ' + results['target'], test=results['test'])
+          for case_id, results in get_data_for_test_cases(test_cases).items()}
@@ -0,0 +1,442 @@
+"""Model backends: prompts plus sampling parameters in, decodes out."""
+
+from dataclasses import dataclass
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from . import tokens
+
+@dataclass(frozen=True)
+class SamplingParams:
+  n : int = 128
+  temperature : float = 0.5
+  max_tokens : int = 128
+  stop : str = "[END]"
+
+  def replace(self, **kwargs) -> "SamplingParams":
+    return SamplingParams(**{**self.__dict__, **kwargs})
+
+
+class Backend:
+  """Base class for all model backends.
+
+  Subclasses implement `sample`, which takes a batch of prompts (usually drawn
+  from many different test cases) and returns a list of `params.n` decodes for
+  each prompt, in order.
+  """
+  registry : Dict[str, Any] = dict()
+  name : str = ""
+
+  @classmethod
+  def register(cls, name : str):
+    def wrapper(backend_cls):
+      backend_cls.name = name
+      cls.registry[name] = backend_cls
+      return backend_cls
+    return wrapper
+
+  @classmethod
+  def get_backend(cls, name : str, flags : Any = None, **kwargs) -> "Backend":
+    """Builds the backend registered as `name`, from `flags` (see `from_flags`) if given, else from `kwargs`."""
+    assert name in cls.registry, f"Backend {name} not recognized; options include {sorted(cls.registry)}"
+    if flags is not None: return cls.registry[name].from_flags(flags, **kwargs)
+    return cls.registry[name](**kwargs)
+
+  @classmethod
+  def from_flags(cls, flags : Any, rpn : Optional[str] = None) -> "Backend":
+    """Builds the backend from the command line flags of `evaluate.py`.
+
+    `rpn`, if given, overrides the model name (e.g. for each of --rpns).
+    Backends with settings override this, reading their own flags.
+    """
+    return cls()
+
+  def sample(self, prompts : List[str], params : SamplingParams) -> List[List[str]]:
+    raise NotImplementedError
+
+  def connection_stats(self) -> Dict[str, Any]:
+    """Counters of the backend's network requests and connections, if it makes any."""
+    return {}
+
+  def sample_stream(self, prompts : List[str], params : SamplingParams, cutoff : Optional[str] = None) -> Iterator[Tuple[int, str]]:
+    """Yields a (prompt index, decode) pair for each decode as soon as it is complete.
+
+    A decode is complete once it reaches `params.stop` or `cutoff`; anything
+    after either may be dropped. Backends that cannot stream yield every
+    decode once `sample` returns.
+    """
+    for i, decodes in enumerate(self.sample(prompts, params)):
+      for decode in decodes:
+        yield i, decode
+
+
+def truncate_at_stop(text : str, stop : Optional[str]) -> str:
+  if stop and stop in text:
+    text = text[:text.index(stop)]
+  return text
+
+
+def is_complete(text : str, stop : Optional[str], cutoff : Optional[str] = None) -> bool:
+  """Whether a partial decode already contains everything that will be kept of it."""
+  return bool(stop and stop in text) or bool(cutoff and cutoff in text)
+
+
+def pack_requests(prompts : List[str],
+                  params : SamplingParams,
+                  max_request_tokens : Optional[int] = None,
+                  max_request_decodes : Optional[int] = None,
+                  tokenizer : tokens.Tokenizer = 'approx') -> List[List[int]]:
+  """Greedily packs prompt indices into requests.
+
+  Each request holds as many consecutive prompts as fit in both budgets: the
+  total prompt tokens plus `params.max_tokens` for every decode, and the total
+  number of decodes. Prompts are measured with `tokenizer` (see `tokens`), as
+  for prompt budgets. A prompt that exceeds a budget on its own is sent alone.
+  """
+  batches : List[List[int]] = []
+  request_tokens, request_decodes = 0, 0
+  for i, prompt in enumerate(prompts):
+    size = tokens.count_tokens(prompt, tokenizer) + params.n * params.max_tokens
+    fits = (max_request_tokens is None or request_tokens + size <= max_request_tokens) and \
+           (max_request_decodes is None or request_decodes + params.n <= max_request_decodes)
+    if not batches or not fits:
+      batches.append([])
+      request_tokens, request_decodes = 0, 0
+    batches[-1].append(i)
+    request_tokens += size
+    request_decodes += params.n
+  return batches
+
+
+def counting_adapter(pool_size : int, on_connect : Callable[[], None]) -> Any:
+  """A `requests` adapter pooling `pool_size` connections per host, which calls `on_connect` for every new connection."""
+  import requests
+  from urllib3 import connectionpool
+
+  class Counting:
+    def connect(self):
+      on_connect()
+      return super().connect()  # type: ignore
+
+  pool_classes = {scheme: type(pool.__name__, (pool,), {'ConnectionCls': type(pool.ConnectionCls.__name__, (Counting, pool.ConnectionCls), {})})
+                  for scheme, pool in (('http', connectionpool.HTTPConnectionPool), ('https', connectionpool.HTTPSConnectionPool))}
+
+  class Adapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+      super().init_poolmanager(*args, **kwargs)
+      self.poolmanager.pool_classes_by_scheme = pool_classes
+
+  return Adapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+
+@dataclass
+class ConnectionStats:
+  """Counters of an HTTP client's requests and connections.
+
+  `request_seconds` is the time until the response headers arrived, summed
+  over requests; `errors` counts connection failures and timeouts.
+  """
+  requests : int = 0
+  retries : int = 0
+  errors : int = 0
+  connections_opened : int = 0
+  request_seconds : float = 0.0
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {**self.__dict__,
+            'connections_reused': max(self.requests - self.errors - self.connections_opened, 0),
+            'mean_request_seconds': self.request_seconds / max(self.requests, 1)}
+
+
+@Backend.register('codex')
+class OpenAIBackend(Backend):
+  """Samples from an OpenAI completions endpoint.
+
+  The endpoint accepts a list of prompts, so several test cases' prompts are
+  packed into one request (see `pack_requests`), and the returned `choices` are
+  routed back to their prompts by index. `sample_stream` requests server-sent
+  events instead, and yields each choice as soon as it is complete.
+
+  Requests go through one pooled client that keeps up to `pool_size`
+  connections alive between requests (a `requests.Session`, or an `httpx`
+  client if `http2` is set), with connect and read timeouts. Overloaded, rate
+  limited and failed requests are retried. `connection_stats` reports how
+  many requests were sent and how many connections were opened for them.
+  """
+
+  def __init__(self,
+               rpn : str = 'cushman',
+               api_key : str = '',
+               url : str = 'https://api.openai.com/v1/engines/code-{rpn}-001/completions',
+               num_retries : int = 3,
+               max_request_tokens : Optional[int] = None,
+               max_request_decodes : Optional[int] = 128,
+               tokenizer : tokens.Tokenizer = 'approx',
+               pool_size : int = 10,
+               keep_alive : bool = True,
+               connect_timeout : float = 10,
+               read_timeout : float = 600,
+               http2 : bool = False):
+    self.rpn = rpn
+    self.api_key = api_key
+    self.url = url.format(rpn=rpn)
+    self.num_retries = num_retries
+    self.max_request_tokens = max_request_tokens
+    self.max_request_decodes = max_request_decodes
+    self.tokenizer = tokenizer
+    self.pool_size = pool_size
+    self.keep_alive = keep_alive
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.http2 = http2
+    self.client : Any = None
+    self.stats = ConnectionStats()
+    self.lock = threading.Lock()
+
+  @classmethod
+  def from_flags(cls, flags : Any, rpn : Optional[str] = None) -> "OpenAIBackend":
+    return cls(rpn=rpn or flags.rpn, api_key=flags.openai_key, url=flags.openai_url,
+               max_request_tokens=flags.max_request_tokens,
+               max_request_decodes=flags.max_request_decodes, tokenizer=flags.tokenizer,
+               pool_size=flags.pool_size, keep_alive=flags.keep_alive,
+               connect_timeout=flags.connect_timeout, read_timeout=flags.read_timeout,
+               http2=flags.http2)
+
+  def get_client(self) -> Any:
+    """Returns the pooled HTTP client, creating it on first use."""
+    with self.lock:
+      if self.client is None:
+        if self.http2:
+          import httpx
+          self.client = httpx.Client(http2=True,
+                                     limits=httpx.Limits(max_connections=self.pool_size,
+                                                         max_keepalive_connections=self.pool_size if self.keep_alive else 0),
+                                     timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout))
+        else:
+          import requests
+          self.client = requests.Session()
+          adapter = counting_adapter(self.pool_size, lambda: self.count(connections_opened=1))
+          self.client.mount('http://', adapter)
+          self.client.mount('https://', adapter)
+          if not self.keep_alive: self.client.headers['Connection'] = 'close'
+      return self.client
+
+  def count(self, **increments):
+    with self.lock:
+      for name, increment in increments.items():
+        setattr(self.stats, name, getattr(self.stats, name) + increment)
+
+  def trace(self, event : str, info : Dict[str, Any]):
+    # httpx reports each new connection through the `trace` request extension.
+    if event == 'connection.connect_tcp.complete': self.count(connections_opened=1)
+
+  def transport_errors(self) -> Tuple[type, ...]:
+    if self.http2:
+      import httpx
+      return (httpx.TransportError,)
+    import requests
+    return (requests.ConnectionError, requests.Timeout)
+
+  def send(self, payload : Dict[str, Any], stream : bool) -> Any:
+    client = self.get_client()
+    headers = {'Authorization': f'Bearer {self.api_key}'}
+    if self.http2:
+      request = client.build_request('POST', self.url, json=payload, headers=headers, extensions={'trace': self.trace})
+      response = client.send(request, stream=stream)
+      if stream and response.status_code != 200: response.read()
+      return response
+    return client.post(self.url, json=payload, headers=headers, stream=stream,
+                       timeout=(self.connect_timeout, self.read_timeout))
+
+  def post(self, payload : Dict[str, Any], stream : bool = False) -> Any:
+    """Sends a completions request, retrying when overloaded, rate limited or on connection failures."""
+    errors = self.transport_errors()
+    for i in range(self.num_retries):
+      if i: self.count(retries=1)
+      start = time.time()
+      try:
+        response = self.send(payload, stream)
+      except errors:
+        self.count(errors=1)
+        if i == self.num_retries - 1: raise
+        time.sleep(2**i)
+        continue
+      finally:
+        self.count(requests=1, request_seconds=time.time() - start)
+      if response.status_code != 200 and ('is currently overloaded' in response.text or 'Rate limit' in response.text):
+        response.close()
+        time.sleep(60*i)
+      else:
+        break
+    assert response.status_code == 200, response.text
+    return response
+
+  def connection_stats(self) -> Dict[str, Any]:
+    with self.lock:
+      return self.stats.to_dict()
+
+  def close(self):
+    with self.lock:
+      if self.client is not None: self.client.close()
+      self.client = None
+
+  def make_request(self, prompts : List[str], params : SamplingParams) -> List[List[str]]:
+    response = self.post({
+      "prompt": prompts,
+      "stop": params.stop,
+      "max_tokens": params.max_tokens,
+      "temperature": float(params.temperature),
+      "n": params.n,
+    })
+    return split_choices(response.json()['choices'], len(prompts), params.n)
+
+  def sample(self, prompts : List[str], params : SamplingParams) -> List[List[str]]:
+    out : List[List[str]] = [[] for _ in prompts]
+    for request in pack_requests(prompts, params, self.max_request_tokens, self.max_request_decodes, self.tokenizer):
+      for i, decodes in zip(request, self.make_request([prompts[i] for i in request], params)):
+        out[i] = decodes
+    return out
+
+  def stream_request(self, prompts : List[str], params : SamplingParams, cutoff : Optional[str] = None) -> Iterator[Tuple[int, str]]:
+    """Yields (choice index, text) for the choices of one streamed request, as each is complete.
+
+    The connection is closed as soon as every choice is complete, without
+    waiting for the server to finish generating past the cutoff.
+    """
+    response = self.post({
+      "prompt": prompts,
+      "stop": params.stop,
+      "max_tokens": params.max_tokens,
+      "temperature": float(params.temperature),
+      "n": params.n,
+      "stream": True,
+    }, stream=True)
+
+    num_choices = len(prompts) * params.n
+    texts : Dict[int, str] = {}
+    done = set()
+    try:
+      for line in (response.iter_lines() if self.http2 else response.iter_lines(decode_unicode=True)):
+        if not line or not line.startswith('data:'): continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]': break
+        for choice in json.loads(data)['choices']:
+          index = choice['index']
+          if index in done: continue
+          texts[index] = texts.get(index, '') + choice['text']
+          if choice.get('finish_reason') or is_complete(texts[index], params.stop, cutoff):
+            done.add(index)
+            yield index, truncate_at_stop(texts[index], params.stop)
+        if len(done) == num_choices: break
+    finally:
+      response.close()
+    for index in range(num_choices):
+      if index not in done: yield index, truncate_at_stop(texts.get(index, ''), params.stop)
+
+  def sample_stream(self, prompts : List[str], params : SamplingParams, cutoff : Optional[str] = None) -> Iterator[Tuple[int, str]]:
+    for request in pack_requests(prompts, params, self.max_request_tokens, self.max_request_decodes, self.tokenizer):
+      for index, text in self.stream_request([prompts[i] for i in request], params, cutoff):
+        yield request[index // params.n], text
+
+
+def split_choices(choices : List[Dict[str, Any]], num_prompts : int, n : int) -> List[List[str]]:
+  """Routes the choices of a multi-prompt completion back to their prompts.
+
+  The endpoint numbers the choices for prompt `p` from `p * n` to `p * n + n - 1`.
+  """
+  out : List[List[str]] = [[] for _ in range(num_prompts)]
+  for choice in sorted(choices, key=lambda choice: choice['index']):
+    out[choice['index'] // n].append(choice['text'])
+  return out
+
+
+@Backend.register('local')
+class LocalBackend(Backend):
+  """Samples from an in-process model, grouping prompts into batched forward calls.
+
+  Prompts from different test cases are packed into batches of at most
+  `batch_size` prompts; each batch is decoded with a single call to
+  `generate_fn(prompts, params)`, which must return `params.n` decodes per
+  prompt. If no `generate_fn` is given, a HuggingFace causal LM named
+  `model_name` is loaded on first use.
+  """
+
+  def __init__(self,
+               model_name : str = '',
+               batch_size : int = 16,
+               generate_fn : Optional[Callable[[List[str], SamplingParams], List[List[str]]]] = None,
+               device : Optional[str] = None):
+    assert model_name or generate_fn, "Either a model name or a generate_fn must be given."
+    self.model_name = model_name
+    self.batch_size = batch_size
+    self.generate_fn = generate_fn
+    self.device = device
+
+  @classmethod
+  def from_flags(cls, flags : Any, rpn : Optional[str] = None) -> "LocalBackend":
+    return cls(model_name=rpn or flags.local_model, batch_size=flags.batch_size)
+
+  def load_model(self):
+    import torch
+    import transformers
+    tokenizer = transformers.AutoTokenizer.from_pretrained(self.model_name, padding_side='left')
+    if tokenizer.pad_token is None: tokenizer.pad_token = tokenizer.eos_token
+    model = transformers.AutoModelForCausalLM.from_pretrained(self.model_name)
+    device = self.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    model.to(device).eval()
+
+    def generate_fn(prompts : List[str], params : SamplingParams) -> List[List[str]]:
+      inputs = tokenizer(prompts, return_tensors='pt', padding=True).to(device)
+      with torch.no_grad():
+        outputs = model.generate(**inputs,
+                                 do_sample=params.temperature > 0,
+                                 temperature=params.temperature if params.temperature > 0 else None,
+                                 max_new_tokens=params.max_tokens,
+                                 num_return_sequences=params.n,
+                                 pad_token_id=tokenizer.pad_token_id)
+      texts = tokenizer.batch_decode(outputs[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+      return [texts[i*params.n:(i+1)*params.n] for i in range(len(prompts))]
+
+    return generate_fn
+
+  def sample(self, prompts : List[str], params : SamplingParams) -> List[List[str]]:
+    if self.generate_fn is None: self.generate_fn = self.load_model()
+    out : List[List[str]] = []
+    for i in range(0, len(prompts), self.batch_size):
+      batch = self.generate_fn(prompts[i:i+self.batch_size], params)
+      out += [[truncate_at_stop(decode, params.stop) for decode in decodes] for decodes in batch]
+    return out
+
+
+@Backend.register('stub')
+class StubBackend(Backend):
+  """A deterministic backend, for exercising the harness without a model.
+
+  Each prompt's decodes are drawn from `responses` (or `responses(prompt)`, if
+  callable) with a random generator seeded by the prompt and the number of
+  times it has been seen, so every run yields the same decodes. Every call is
+  recorded in `self.calls`.
+  """
+
+  def __init__(self,
+               responses : Any = ("return None",),
+               seed : int = 0):
+    self.responses = responses
+    self.seed = seed
+    self.calls : List[List[str]] = []
+    self.prompt_counts : Dict[str, int] = {}
+
+  def sample(self, prompts : List[str], params : SamplingParams) -> List[List[str]]:
+    self.calls.append(list(prompts))
+    out = []
+    for prompt in prompts:
+      candidates : Sequence[str] = self.responses(prompt) if callable(self.responses) else self.responses
+      count = self.prompt_counts.get(prompt, 0)
+      self.prompt_counts[prompt] = count + 1
+      rng = random.Random(hashlib.sha1(f'{self.seed}:{count}:{prompt}'.encode()).hexdigest())
+      out.append([truncate_at_stop(rng.choice(candidates), params.stop) for _ in range(params.n)])
+    return out
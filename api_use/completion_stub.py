@@ -0,0 +1,115 @@
+"""A local stand-in for an OpenAI completions endpoint, for running the codex backend offline.
+
+  python3 -m api_use.completion_stub --port 8001 --token_delay 0.01
+  python3 evaluate.py --openai_url http://127.0.0.1:8001/completions --stream ...
+
+Decodes are drawn as by `backends.StubBackend`, followed by `tail` (what a
+model might go on to write after the function) and truncated at the request's
+stop sequence. With `"stream": true`, the choices are sent as server-sent
+events of `chunk_size` characters, interleaved across choices, `token_delay`
+seconds apart, and a choice's last event has `finish_reason` set. Otherwise
+the whole response is sent after as long as streaming it would have taken.
+"""
+
+import http.server
+import json
+import threading
+import time
+from typing import Any, Dict, List
+
+from absl import logging
+
+from . import backends
+
+DEFAULT_TAIL = "\n\n\ndef unused():\n    return None\n"
+
+def make_choices(request : Dict[str, Any], backend : backends.StubBackend, tail : str) -> List[Dict[str, Any]]:
+  prompts = request['prompt'] if isinstance(request['prompt'], list) else [request['prompt']]
+  params = backends.SamplingParams(n=request.get('n', 1), stop=request.get('stop'))
+  decodes = backend.sample(prompts, params.replace(stop=None))
+  return [{'text': backends.truncate_at_stop(decode + tail, params.stop), 'index': i * params.n + j, 'finish_reason': 'stop'}
+          for i, prompt_decodes in enumerate(decodes) for j, decode in enumerate(prompt_decodes)]
+
+def make_handler(backend : backends.StubBackend, tail : str, chunk_size : int, token_delay : float):
+  lock = threading.Lock()
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # so that clients can keep connections alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+      request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+      with lock:
+        choices = make_choices(request, backend, tail)
+      num_chunks = max((len(choice['text']) for choice in choices), default=0) // chunk_size + 1
+      if not request.get('stream'):
+        time.sleep(num_chunks * token_delay)  # as long as streaming every chunk takes
+        body = json.dumps({'object': 'text_completion', 'choices': choices}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+      # The event stream has no length, so it ends when the connection is closed.
+      self.close_connection = True
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/event-stream')
+      self.send_header('Connection', 'close')
+      self.end_headers()
+      try:
+        for start in range(0, num_chunks * chunk_size, chunk_size):
+          for choice in choices:
+            if start > len(choice['text']): continue
+            text = choice['text'][start:start + chunk_size]
+            finished = start + chunk_size > len(choice['text'])
+            event = {'object': 'text_completion',
+                     'choices': [{'text': text, 'index': choice['index'], 'finish_reason': 'stop' if finished else None}]}
+            self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode())
+          self.wfile.flush()
+          if token_delay: time.sleep(token_delay)
+        self.wfile.write(b'data: [DONE]\n\n')
+      except (BrokenPipeError, ConnectionResetError):
+        pass  # the client has every choice it needs
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      logging.debug(format, *args)
+
+  return Handler
+
+
+def serve(port : int,
+          host : str = '127.0.0.1',
+          responses : Any = ("return None",),
+          tail : str = DEFAULT_TAIL,
+          chunk_size : int = 4,
+          token_delay : float = 0.0) -> http.server.ThreadingHTTPServer:
+  """Starts a server in a background thread and returns it; call `.shutdown()` to stop it."""
+  handler = make_handler(backends.StubBackend(responses), tail, chunk_size, token_delay)
+  server = http.server.ThreadingHTTPServer((host, port), handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+if __name__ == '__main__':
+  from absl import app
+  from absl import flags
+
+  flags.DEFINE_string('host', '127.0.0.1', 'The address to listen on.')
+  flags.DEFINE_integer('port', 8001, 'The port to listen on.')
+  flags.DEFINE_list('responses', ['return None'], 'The decodes to draw from.')
+  flags.DEFINE_integer('chunk_size', 4, 'The number of characters per streamed event.')
+  flags.DEFINE_float('token_delay', 0.01, 'The delay between streamed events, in seconds.')
+  FLAGS = flags.FLAGS
+
+  def main(argv):
+    server = serve(FLAGS.port, FLAGS.host, responses=FLAGS.responses, chunk_size=FLAGS.chunk_size, token_delay=FLAGS.token_delay)
+    print(f'Serving completions on {FLAGS.host}:{FLAGS.port}.')
+    try:
+      while True: time.sleep(3600)
+    except KeyboardInterrupt:
+      server.shutdown()
+
+  app.run(main)
@@ -1,45 +1,164 @@
+import ast
+import functools
 import json
-from typing import List
+import os
+from typing import Any, Dict, List, Tuple
 
 from . import execution_utils
+from . import testspec
 
 DUMMY_CODE = """
 class Dummy:
-  def __init__(self, s='main'):
-    self.s = s
-    self.func_calls = []
-  def __eq__(self, other):
-    return self.s == other.s
+  # Records a chain of calls (e.g. image.rotate(x).blur(y)) as a linked list of
+  # interned (name, positional args, keyword args) tuples with an incremental
+  # hash. Positional args are compared by their string values (nested Dummies
+  # by their chains); keyword args are only compared if Dummy.STRICT is set.
+  __slots__ = ('_parent', '_call', '_hash', '_depth')
+  STRICT = False
+  _intern = staticmethod(__import__('sys').intern)
+
+  class _Attribute:
+    __slots__ = ('_obj', '_name')
+    def __init__(self, obj, name):
+      self._obj = obj
+      self._name = name
+    def __call__(self, *args, **kwargs):
+      key = Dummy._key
+      return Dummy(self._obj, (self._name,
+                               tuple([key(arg) for arg in args]),
+                               tuple(sorted([(k, key(v)) for k, v in kwargs.items()]))))
+
+  def __init__(self, parent=None, call=None):
+    self._parent = parent
+    self._call = call
+    if parent is None:
+      self._hash = 0
+      self._depth = 0
+    else:
+      self._hash = hash((parent._hash, call[0], call[1]))
+      self._depth = parent._depth + 1
+
+  @staticmethod
+  def _key(x):
+    return x if isinstance(x, Dummy) else Dummy._intern(str(x))
+
   def __getattr__(self, name):
-    def func(*args, **kwargs):
-      print(self.func_calls)
-      signature = Dummy(self.s + "." + name + "(" +  ",".join(str(x) for x in args) + ")")
-      #self.func_calls.append(signature)
-      return signature
-    return func
+    if name[:2] == '__': raise AttributeError(name)
+    return Dummy._Attribute(self, Dummy._intern(name))
+
+  def __hash__(self):
+    return self._hash
+
+  def __eq__(self, other):
+    if not isinstance(other, Dummy): return NotImplemented
+    if self._hash != other._hash or self._depth != other._depth: return False
+    a, b = self, other
+    while a is not b and a._parent is not None:
+      (a_name, a_args, a_kwargs), (b_name, b_args, b_kwargs) = a._call, b._call
+      if a_name != b_name or a_args != b_args or (Dummy.STRICT and a_kwargs != b_kwargs): return False
+      a, b = a._parent, b._parent
+    return True
+
   def __str__(self):
-    return 'D<' + self.s + '>'
+    calls = []
+    node = self
+    while node._parent is not None:
+      name, args, kwargs = node._call
+      calls.append(name + '(' + ','.join([str(arg) for arg in args] + [k + '=' + str(v) for k, v in kwargs]) + ')')
+      node = node._parent
+    return 'D<' + '.'.join(['main'] + calls[::-1]) + '>'
+
   def __repr__(self):
     return str(self)
+
+  def _trace(self):
+    # The chain as nested tuples of strings, comparable with == (and safe to
+    # embed as a literal) wherever the Dummy class itself is not available.
+    calls = []
+    node = self
+    while node._parent is not None:
+      name, args, kwargs = node._call
+      calls.append((name,
+                    tuple([arg._trace() if isinstance(arg, Dummy) else arg for arg in args]),
+                    tuple([(k, v._trace() if isinstance(v, Dummy) else v) for k, v in kwargs]) if Dummy.STRICT else ()))
+      node = node._parent
+    return tuple(calls[::-1])
 """
 
-def execute(sample, test):
-  signature, indent, dummy_defn, style = test.split('\n')[:4]
-  dummy_obj = dummy_defn.split(' ')[0]
-  style = style.split('=')[1].strip()
-  is_import_style = (style == "'import_style'")
-  indent = indent.split("'")[1]
-  prefix = signature.split('=')[1].strip() + '\n' + indent + f'global Dummy\n' + (f'{indent}global {dummy_obj}\n' if is_import_style else '') + indent
-  test_setup = DUMMY_CODE + '\n' + dummy_defn
-  #print("setup", test_setup)
-  test = '\n'.join(test.split('\n')[3:])
+@functools.lru_cache(maxsize=2)
+def get_recorder(strict : bool = False):
+  """Returns the Dummy class from DUMMY_CODE, for use outside of sandboxed execution."""
+  namespace : Dict[str, Any] = {}
+  exec(DUMMY_CODE + ('Dummy.STRICT = True\n' if strict else ''), namespace)  # pylint: disable=exec-used
+  return namespace['Dummy']
+
+def _is_literal(node : ast.AST) -> bool:
+  if isinstance(node, ast.Constant): return True
+  if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)): return _is_literal(node.operand)
+  if isinstance(node, (ast.Tuple, ast.List, ast.Set)): return all(_is_literal(elt) for elt in node.elts)
+  if isinstance(node, ast.Dict): return all(k is not None and _is_literal(k) and _is_literal(v) for k, v in zip(node.keys, node.values))
+  return False
+
+def _is_call_chain(node : ast.AST, dummy_name : str) -> bool:
+  if isinstance(node, ast.Name): return node.id == dummy_name
+  if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)): return False
+  if node.func.attr.startswith('__') or not _is_call_chain(node.func.value, dummy_name): return False
+  return all(_is_literal(arg) or _is_call_chain(arg, dummy_name) for arg in node.args) and \
+         all(kw.arg is not None and (_is_literal(kw.value) or _is_call_chain(kw.value, dummy_name)) for kw in node.keywords)
+
+def check_target_call(test : testspec.TestSpec):
+  """Raises ValueError unless the test's target is a `dummy.f(...).g(...)` call chain over literals."""
+  try:
+    tree = ast.parse(test.target_call, mode='eval')
+  except SyntaxError as e:
+    raise ValueError(f'Invalid target call {test.target_call!r}: {e}') from None
+  if not _is_call_chain(tree.body, test.dummy_name):
+    raise ValueError(f'Target call {test.target_call!r} is not a call chain on {test.dummy_name!r} over literals.')
+
+@functools.lru_cache(maxsize=4096)
+def expected_trace(test : testspec.TestSpec, strict : bool = False) -> Tuple[Any, str]:
+  """Returns the call trace of the test's target and its printable form, computed once per test."""
+  check_target_call(test)
+  Dummy = get_recorder(strict)
+  y = eval(test.target_call, {'__builtins__': {}, test.dummy_name: Dummy()})  # pylint: disable=eval-used
+  assert isinstance(y, Dummy), f'Target call {test.target_call!r} evaluated to {y!r}, not a Dummy.'
+  return y._trace(), str(y)
+
+@functools.lru_cache(maxsize=4096)
+def compile_test(test : testspec.TestSpec, strict : bool = False) -> Tuple[str, str]:
+  """Returns the code preceding each decode, and the check that follows it.
+
+  The check compares the decode's call trace against the cached expected
+  trace instead of re-evaluating the target for every decode.
+  """
+  indent = test.indent
+  prefix = test.signature + '\n' + indent + f'global Dummy\n' + (f'{indent}global {test.dummy_name}\n' if test.is_import_style else '') + indent
+  trace, printable = expected_trace(test, strict)
+  check = (f"x = {test.test_call}\n"
+           f"assert isinstance(x, Dummy) and x._trace() == {trace!r}, 'Test failure: ' + str(x) + ' != ' + {printable!r}")
+  return f'{test.dummy_name} = Dummy()\n' + prefix, check
+
+# `host:port` addresses of execution servers (see `execution_server`) to score
+# on instead of in this process, e.g. from API_USE_EXECUTION_SERVERS=a:8000,b:8000.
+SERVERS = [server for server in os.environ.get('API_USE_EXECUTION_SERVERS', '').split(',') if server]
+
+def execute(sample, test, isolation=None, strict=False, timeout=10, servers=None):
+  servers = SERVERS if servers is None else servers
+  if servers:
+    from . import execution_server
+    results = execution_server.Client(servers).execute(sample if isinstance(sample, list) else [sample], test,
+                                                       strict=strict, timeout=timeout)
+    return results[0] if len(results) == 1 else results
 
+  test = testspec.TestSpec.parse(test)
+  setup, check = compile_test(test, strict)
+  preamble = DUMMY_CODE + ('Dummy.STRICT = True\n' if strict else '')
 
   if not isinstance(sample, list): sample = [sample]
   # s = sample[0]
-  # print(":::" + test_setup + '\n' + prefix + s)
+  # print(":::" + preamble + '\n' + setup + s)
   results = [
-      execution_utils.run_tests(test_setup + '\n' + prefix + s, [test], test_setup_code="")
+      execution_utils.run_tests(setup + s, [check], test_setup_code="", timeout=timeout, isolation=isolation, preamble=preamble)
       for s in sample # tqdm.tqdm(sample)
   ]
   #print(json.dumps([r.error_text.split('\n') for r in results if r.error_text], indent=2))
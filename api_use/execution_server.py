@@ -0,0 +1,249 @@
+"""An HTTP service that scores decodes, so scoring can run on other machines.
+
+Start one server per scoring node:
+
+  python3 -m api_use.execution_server --port 8000 --num_workers 16
+
+and point clients at them, either with `execution.execute(..., servers=[...])`
+or for a whole process with API_USE_EXECUTION_SERVERS=node1:8000,node2:8000.
+
+The API is JSON over HTTP:
+
+  POST /submit  {"samples": [...], "test": <TestSpec dict>, "strict": false, "timeout": 10}
+                -> {"job_id": ...}
+  GET  /poll?job_id=...&wait=5
+                -> {"status": "pending" | "done", "results": [[correct, error], ...]}
+                   or {"status": "error", "error": ...} if the harness failed
+  GET  /health  -> {"status": "ok", "num_workers": ..., "pending_jobs": ..., ...}
+
+Every decode of a job runs in a subprocess from the server's worker pool
+with the job's timeout. `poll` waits up to `wait` seconds for the job to
+finish, and forgets a job once its results have been returned.
+"""
+
+import concurrent.futures
+from dataclasses import dataclass, field
+import http.server
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from absl import logging
+
+from . import execution
+from . import execution_utils
+from . import testspec
+
+@dataclass
+class Job:
+  id : str
+  num_samples : int
+  results : List[Optional[Tuple[bool, Optional[str]]]]
+  submitted : float
+  finished : Optional[float] = None
+  error : Optional[str] = None  # set if the harness failed on any sample
+  done : threading.Event = field(default_factory=threading.Event)
+
+
+class ExecutionService:
+  """Scores submitted jobs on a pool of `num_workers` subprocesses."""
+
+  def __init__(self, num_workers : int, job_ttl : float = 600, memory_limit : Optional[int] = None):
+    execution_utils.get_worker_pool(num_workers, memory_limit)
+    self.num_workers = num_workers
+    self.executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+    self.job_ttl = job_ttl
+    self.jobs : Dict[str, Job] = {}
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.num_scored = 0
+    self.num_timeouts = 0
+
+  def submit(self, samples : List[str], test : Any, strict : bool = False, timeout : float = 10) -> str:
+    test = testspec.TestSpec.parse(test)
+    execution.check_target_call(test)
+    job = Job(id=uuid.uuid4().hex, num_samples=len(samples), results=[None] * len(samples), submitted=time.time())
+    with self.lock:
+      self.expire_jobs()
+      self.jobs[job.id] = job
+    if not samples:
+      job.finished = time.time()
+      job.done.set()
+    for i, sample in enumerate(samples):
+      self.executor.submit(self.score, job, i, sample, test, strict, timeout)
+    return job.id
+
+  def score(self, job : Job, i : int, sample : str, test : testspec.TestSpec, strict : bool, timeout : float):
+    error = None
+    try:
+      result = execution.execute(sample, test, isolation='subprocess', strict=strict, timeout=timeout, servers=[])
+    except Exception as e:  # pylint: disable=broad-except
+      # wrong answers are results; anything raised is the harness failing
+      result, error = (False, None), f'Scoring failed: {e!r}'
+    with self.lock:
+      job.results[i] = result
+      if error and not job.error: job.error = error
+      self.num_scored += 1
+      if result[1] and result[1].startswith('The function was not able to complete'): self.num_timeouts += 1
+      if all(r is not None for r in job.results):
+        job.finished = time.time()
+        job.done.set()
+
+  def poll(self, job_id : str, wait : float = 0) -> Dict[str, Any]:
+    with self.lock:
+      job = self.jobs.get(job_id)
+    if job is None: return {'status': 'unknown'}
+    if not job.done.wait(wait): return {'status': 'pending'}
+    with self.lock:
+      self.jobs.pop(job_id, None)
+    if job.error: return {'status': 'error', 'error': job.error}
+    return {'status': 'done', 'results': job.results, 'latency': job.finished - job.submitted}
+
+  def expire_jobs(self):
+    # Finished jobs whose client never collected them.
+    now = time.time()
+    for job_id in [job.id for job in self.jobs.values() if job.finished and now - job.finished > self.job_ttl]:
+      del self.jobs[job_id]
+
+  def health(self) -> Dict[str, Any]:
+    with self.lock:
+      pending = [job for job in self.jobs.values() if not job.done.is_set()]
+      return {
+        'status': 'ok',
+        'num_workers': self.num_workers,
+        'pending_jobs': len(pending),
+        'pending_samples': sum(sum(r is None for r in job.results) for job in pending),
+        'scored_samples': self.num_scored,
+        'timeouts': self.num_timeouts,
+        'uptime': time.time() - self.started,
+      }
+
+  def shutdown(self):
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def make_handler(service : ExecutionService):
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def reply(self, data : Dict[str, Any], code : int = 200):
+      body = json.dumps(data).encode()
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      url = urllib.parse.urlparse(self.path)
+      query = dict(urllib.parse.parse_qsl(url.query))
+      if url.path == '/health':
+        self.reply(service.health())
+      elif url.path == '/poll':
+        self.reply(service.poll(query['job_id'], wait=min(float(query.get('wait', 0)), 60)))
+      else:
+        self.reply({'error': f'{url.path} not found'}, 404)
+
+    def do_POST(self):
+      if self.path != '/submit':
+        self.reply({'error': f'{self.path} not found'}, 404)
+        return
+      request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+      try:
+        job_id = service.submit(request['samples'], request['test'],
+                                strict=request.get('strict', False), timeout=request.get('timeout', 10))
+      except (KeyError, TypeError, ValueError) as e:
+        self.reply({'error': repr(e)}, 400)
+        return
+      self.reply({'job_id': job_id})
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      logging.debug(format, *args)
+
+  return Handler
+
+
+def serve(port : int, num_workers : int, host : str = '127.0.0.1', memory_limit : Optional[int] = None) -> http.server.ThreadingHTTPServer:
+  """Starts a server in a background thread and returns it; call `.shutdown()` to stop it."""
+  service = ExecutionService(num_workers, memory_limit=memory_limit)
+  server = http.server.ThreadingHTTPServer((host, port), make_handler(service))
+  server.daemon_threads = True
+  server.service = service  # type: ignore
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+class Client:
+  """Spreads the scoring of a batch of decodes across execution servers.
+
+  The samples are split into one contiguous chunk per server, submitted, and
+  polled until every chunk is done. A chunk whose server cannot be reached is
+  submitted to the next server instead.
+  """
+
+  def __init__(self, servers : Sequence[str], poll_wait : float = 5, request_timeout : float = 60):
+    assert servers, "At least one server is needed."
+    self.servers = list(servers)
+    self.poll_wait = poll_wait
+    self.request_timeout = request_timeout
+
+  def request(self, server : str, path : str, payload : Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(f'http://{server}{path}', data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=self.request_timeout) as response:
+      return json.loads(response.read())
+
+  def health(self, server : str) -> Dict[str, Any]:
+    return self.request(server, '/health')
+
+  def submit(self, first_server : int, samples : List[str], test : Dict[str, str], strict : bool, timeout : float) -> Tuple[str, str]:
+    for i in range(len(self.servers)):
+      server = self.servers[(first_server + i) % len(self.servers)]
+      try:
+        response = self.request(server, '/submit', {'samples': samples, 'test': test, 'strict': strict, 'timeout': timeout})
+        return server, response['job_id']
+      except (urllib.error.URLError, OSError) as e:
+        logging.warning('Execution server %s failed: %r', server, e)
+    raise ConnectionError(f'None of the execution servers {self.servers} could be reached.')
+
+  def execute(self, samples : List[str], test : Any, strict : bool = False, timeout : float = 10) -> List[Tuple[bool, Optional[str]]]:
+    test_dict = testspec.TestSpec.parse(test).to_dict()
+    chunk_size = -(-len(samples) // len(self.servers)) or 1
+    jobs = [self.submit(i, samples[start:start + chunk_size], test_dict, strict, timeout)
+            for i, start in enumerate(range(0, len(samples), chunk_size))]
+    results : List[Tuple[bool, Optional[str]]] = []
+    for server, job_id in jobs:
+      while True:
+        response = self.request(server, f'/poll?job_id={job_id}&wait={self.poll_wait}')
+        if response['status'] == 'done': break
+        if response['status'] == 'error':
+          raise execution_utils.WorkerError(f'Execution server {server} failed on job {job_id}: {response["error"]}')
+        assert response['status'] == 'pending', f'Job {job_id} is unknown to {server}.'
+      results += [tuple(result) for result in response['results']]
+    return results
+
+
+if __name__ == '__main__':
+  from absl import app
+  from absl import flags
+
+  flags.DEFINE_string('host', '127.0.0.1', 'The address to listen on.')
+  flags.DEFINE_integer('port', 8000, 'The port to listen on.')
+  flags.DEFINE_integer('num_workers', 8, 'The number of scoring subprocesses.')
+  flags.DEFINE_integer('memory_limit_mb', 1024, 'The address space limit of each scoring subprocess (0 for none).')
+  FLAGS = flags.FLAGS
+
+  def main(argv):
+    server = serve(FLAGS.port, FLAGS.num_workers, FLAGS.host, memory_limit=FLAGS.memory_limit_mb * 2**20 or None)
+    print(f'Scoring on {FLAGS.host}:{FLAGS.port} with {FLAGS.num_workers} workers.')
+    try:
+      while True: time.sleep(3600)
+    except KeyboardInterrupt:
+      server.shutdown()
+      server.service.shutdown()  # type: ignore
+
+  app.run(main)
@@ -1,37 +1,35 @@
 """Utilities for evaluating and formatting examples."""
 
-import ast
-import collections
+import atexit
+import builtins
 import contextlib
-import copy
 import dataclasses
 import enum
+import functools
 import io
-import itertools
-import json
-import multiprocessing as mp
+import logging
+import os
+import pickle
+import queue
 import signal
 import sys
+import threading
 import traceback
 import types
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from absl import logging
-import astunparse
+# Only the standard library is imported here, since every scoring worker
+# imports this module on start; see `api_use.import_budget`.
+logger = logging.getLogger(__name__)
 
-@contextlib.contextmanager
-def suppress_stdio():
-  """Prevents anything in the enclosing context from printing."""
-  stdout = sys.stdout
-  stderr = sys.stderr
-  sys.stdout = None
-  sys.stderr = None
+class WorkerError(RuntimeError):
+  """The execution harness failed, as opposed to the code it was running; not a verdict on the code."""
 
-  try:
+@contextlib.contextmanager
+def capture_stdio(buffer: io.StringIO):
+  """Sends anything written to sys.stdout or sys.stderr in the enclosing context to `buffer`."""
+  with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(buffer):
     yield
-  finally:
-    sys.stdout = stdout
-    sys.stderr = stderr
 
 @contextlib.contextmanager
 def register_alarm(signal_id, handler):
@@ -42,18 +40,29 @@ def register_alarm(signal_id, handler):
   finally:
     signal.signal(signal_id, old_handler)
 
-def exec_with_timeout(code: str, timeout: int = 10) -> Dict[str, str]:
-  """A safe version of exec which allows for a timeout exception.
+@functools.lru_cache(maxsize=64)
+def compile_preamble(preamble: str) -> types.CodeType:
+  return compile(preamble, '<preamble>', 'exec')
 
-  Args:
-    code: the code text to execute.
-    timeout: a timeout value in seconds to execute
-  Returns:
-    dictionary with variables from local execution.
+def isolated_globals(stdout: io.StringIO, preamble: str = '') -> Dict[str, Any]:
+  """Returns exec globals whose `print` writes to `stdout` instead of sys.stdout.
 
-  Raises:
-    ValueError: on any exception in the subprocess.
-    TimeoutError: on any timeout.
+  Code that writes to the streams directly is caught by `capture_stdio`,
+  which callers also enter. If given, the preamble is compiled once and
+  executed into the returned globals.
+  """
+  def captured_print(*args, **kwargs):
+    kwargs.setdefault('file', stdout)
+    print(*args, **kwargs)
+  exec_globals = {'__builtins__': builtins, 'print': captured_print}
+  if preamble:
+    exec(compile_preamble(preamble), exec_globals)  # pylint: disable=exec-used
+  return exec_globals
+
+def exec_with_signal_timeout(code: str, timeout: int = 10, preamble: str = '') -> Dict[str, str]:
+  """Runs `exec` in-process, interrupting it with SIGALRM after `timeout` seconds.
+
+  Only usable from the main thread of the main interpreter.
   """
 
   def alarm_handler(signum, frame):
@@ -63,10 +72,11 @@ def exec_with_timeout(code: str, timeout: int = 10) -> Dict[str, str]:
     signal.alarm(timeout)
 
     try:
-      with suppress_stdio():
-        var_dict = {}
-        exec(code, {}, var_dict)  # pylint: disable=exec-used
-        return var_dict
+      var_dict = {}
+      stdout = io.StringIO()
+      with capture_stdio(stdout):
+        exec(code, isolated_globals(stdout, preamble), var_dict)  # pylint: disable=exec-used
+      return var_dict
     except TimeoutError:
       raise TimeoutError(f'The function was not able to complete before '
                          f'the timeout ({timeout} sec) occurred.')
@@ -77,6 +87,184 @@ def exec_with_timeout(code: str, timeout: int = 10) -> Dict[str, str]:
     finally:
       signal.alarm(0)
 
+def _worker_loop(conn, memory_limit: Optional[int] = None) -> None:
+  """Executes code sent over `conn` until the pipe is closed.
+
+  Replies with ('ok', picklable variables, captured stdout) or ('error',
+  traceback, captured stdout). If `memory_limit` is given, the worker's
+  address space is capped at that many bytes, so runaway allocations raise
+  MemoryError instead of exhausting the host.
+  """
+  if memory_limit:
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+  while True:
+    try:
+      preamble, code = conn.recv()
+    except EOFError:
+      return
+    stdout = io.StringIO()
+    try:
+      var_dict = {}
+      with capture_stdio(stdout):
+        exec(code, isolated_globals(stdout, preamble), var_dict)  # pylint: disable=exec-used
+      picklable = {}
+      for k, v in var_dict.items():
+        try:
+          pickle.dumps(v)
+          picklable[k] = v
+        except Exception:  # pylint: disable=broad-except
+          pass
+      conn.send(('ok', picklable, stdout.getvalue()))
+    except (Exception, SystemExit):
+      conn.send(('error', traceback.format_exc(), stdout.getvalue()))
+
+
+class ExecutionWorker:
+  """A persistent subprocess that executes code sent to it."""
+
+  def __init__(self, ctx, memory_limit: Optional[int] = None):
+    self.conn, child_conn = ctx.Pipe()
+    self.process = ctx.Process(target=_worker_loop, args=(child_conn, memory_limit), daemon=True)
+    self.process.start()
+    child_conn.close()
+
+  def kill(self):
+    self.process.kill()
+    self.process.join()
+    self.conn.close()
+
+
+class WorkerPool:
+  """A thread-safe pool of subprocesses for executing untrusted code with a timeout.
+
+  Each call borrows an idle worker, sends it the code, and waits on the reply
+  with a watchdog timeout. A worker that times out or dies is killed and
+  replaced, so the caller never blocks longer than `timeout`. Because nothing
+  here relies on signals or process-global state, `exec` can be called from
+  any thread or (through `exec_async`) from asyncio tasks.
+  """
+
+  def __init__(self, num_workers: Optional[int] = None, memory_limit: Optional[int] = None):
+    import multiprocessing as mp
+    self.ctx = mp.get_context('forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn')
+    self.num_workers = num_workers or os.cpu_count() or 1
+    self.memory_limit = memory_limit
+    self.idle: 'queue.Queue[Optional[ExecutionWorker]]' = queue.Queue()
+    for _ in range(self.num_workers):
+      self.idle.put(None)  # workers are started lazily
+    self.closed = False
+
+  def exec(self, code: str, timeout: float = 10, preamble: str = '') -> Tuple[Dict[str, Any], str]:
+    """Executes `code` in a worker, returning its picklable variables and stdout.
+
+    Raises:
+      ValueError: on any exception in the subprocess.
+      TimeoutError: on any timeout.
+      WorkerError: if no worker could be started and sent the code, even after a retry.
+    """
+    assert not self.closed, 'The worker pool has been shut down.'
+    worker = self.idle.get()
+    try:
+      # A worker that fails to start, or that is dead before the code is sent,
+      # is replaced once; if that fails too, the harness is at fault. A worker
+      # that dies while running the code was killed by it, which is a verdict.
+      for attempt in range(2):
+        if worker is None or not worker.process.is_alive():
+          try:
+            worker = ExecutionWorker(self.ctx, self.memory_limit)
+          except OSError as e:
+            worker = None
+            failure = f'The worker process could not be started: {e!r}'
+            continue
+        try:
+          worker.conn.send((preamble, code))
+          break
+        except OSError as e:
+          worker.kill()
+          worker = None
+          failure = f'The worker process could not be sent the code: {e!r}'
+          logger.warning('%s; retrying on a fresh worker.' if attempt == 0 else '%s.', failure)
+      else:
+        raise WorkerError(failure)
+      try:
+        ready = worker.conn.poll(timeout)
+        if ready: status, payload, stdout = worker.conn.recv()
+      except (EOFError, OSError):
+        worker.process.join(1)
+        exitcode = worker.process.exitcode
+        worker.kill()
+        worker = None
+        raise ValueError(f'An exception occurred while calling exec. '
+                         f'The worker process exited with code {exitcode}.') from None
+      if not ready:
+        worker.kill()
+        worker = None
+        raise TimeoutError(f'The function was not able to complete before '
+                           f'the timeout ({timeout} sec) occurred.')
+      if status == 'error':
+        raise ValueError(f'An exception occurred while calling exec. '
+                         f'Traceback:\n\n{payload}')
+      return payload, stdout
+    finally:
+      self.idle.put(worker)
+
+  async def exec_async(self, code: str, timeout: float = 10, preamble: str = '') -> Tuple[Dict[str, Any], str]:
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, self.exec, code, timeout, preamble)
+
+  def shutdown(self):
+    self.closed = True
+    while not self.idle.empty():
+      worker = self.idle.get_nowait()
+      if worker is not None: worker.kill()
+
+_worker_pool: Optional[WorkerPool] = None
+_worker_pool_lock = threading.Lock()
+
+def get_worker_pool(num_workers: Optional[int] = None, memory_limit: Optional[int] = None) -> WorkerPool:
+  """Returns the process-wide worker pool, starting it with the given settings on first use."""
+  global _worker_pool
+  with _worker_pool_lock:
+    if _worker_pool is None:
+      _worker_pool = WorkerPool(num_workers, memory_limit)
+      atexit.register(_worker_pool.shutdown)
+    return _worker_pool
+
+def exec_with_timeout(code: str,
+                      timeout: int = 10,
+                      isolation: Optional[str] = None,
+                      preamble: str = '') -> Dict[str, str]:
+  """A safe version of exec which allows for a timeout exception.
+
+  Args:
+    code: the code text to execute.
+    timeout: a timeout value in seconds to execute
+    isolation: 'signal' to run in-process under SIGALRM (main thread only), or
+      'subprocess' to run in a worker from the shared `WorkerPool`. Defaults to
+      'signal' on the main thread and 'subprocess' everywhere else.
+    preamble: code shared across many calls (e.g. class definitions). It is
+      compiled once and executed into the globals of `code`.
+  Returns:
+    dictionary with variables from local execution ('subprocess' isolation
+    only returns the picklable ones).
+
+  Raises:
+    ValueError: on any exception in the subprocess.
+    TimeoutError: on any timeout.
+    WorkerError: if the subprocess harness itself failed.
+  """
+  if isolation is None:
+    isolation = 'signal' if threading.current_thread() is threading.main_thread() else 'subprocess'
+  if isolation == 'signal':
+    return exec_with_signal_timeout(code, timeout=timeout, preamble=preamble)
+  elif isolation == 'subprocess':
+    var_dict, _ = get_worker_pool().exec(code, timeout=timeout, preamble=preamble)
+    return var_dict
+  else:
+    raise ValueError(f'Isolation {isolation} not recognized.')
+
 
 class ResultType(enum.Enum):
   SUCCESS = 1  # The code executed without crashing and returned results.
@@ -107,7 +295,9 @@ def test_string_from_list(test_list: List[str]):
 def run_tests(code: str,
                         test_list: List[str],
                         test_setup_code: str = '',
-                        timeout: int = 10) -> TestResult:
+                        timeout: int = 10,
+                        isolation: Optional[str] = None,
+                        preamble: str = '') -> TestResult:
   """Evaluates a code snipppet on a set of tests.
 
   Args:
@@ -116,6 +306,8 @@ def run_tests(code: str,
       given the code provided.
     test_setup_code: code we must run to set up the tests.
     timeout: a timeout value at which point the code automatically fails.
+    isolation: how the code is isolated; see `exec_with_timeout`.
+    preamble: code compiled once and shared across calls; see `exec_with_timeout`.
 
   Returns:
     a TestResult object containing details about the evaluation.
@@ -123,13 +315,13 @@ def run_tests(code: str,
   test_code = code + '\n\n' + test_setup_code + '\n'
   test_code += test_string_from_list(test_list)
 
-  logging.debug('EXECUTING TESTS:')
-  logging.debug('=' * 80)
-  logging.debug(test_code)
-  logging.debug('=' * 80)
+  logger.debug('EXECUTING TESTS:')
+  logger.debug('=' * 80)
+  logger.debug(test_code)
+  logger.debug('=' * 80)
 
   try:
-    exec_with_timeout(test_code, timeout=timeout)
+    exec_with_timeout(test_code, timeout=timeout, isolation=isolation, preamble=preamble)
     return TestResult(
         code=code,
         test_list=test_list,
@@ -138,10 +330,10 @@ def run_tests(code: str,
         traceback=None,
     )
   except (ValueError, TimeoutError) as e:
-    logging.debug('=' * 80)
-    logging.debug('Test completed with error:')
-    logging.debug(e)
-    logging.debug('=' * 80)
+    logger.debug('=' * 80)
+    logger.debug('Test completed with error:')
+    logger.debug(e)
+    logger.debug('=' * 80)
 
     return TestResult(
         code=code,
@@ -0,0 +1,56 @@
+"""Cold start budgets for the core modules.
+
+Scoring workers and short-lived scoring processes import these modules on
+start, so each must import within its budget and without loading any of the
+heavy dependencies that only the scripts need. Each module is imported in a
+fresh interpreter `repeats` times, and the fastest cumulative time reported by
+`python -X importtime` is compared against the budget:
+
+  python3 -m api_use.import_budget
+"""
+
+import json
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# module -> cold import budget in milliseconds
+BUDGETS = {
+  'api_use': 5,
+  'api_use.testspec': 30,
+  'api_use.execution_utils': 40,
+  'api_use.execution': 50,
+  'api_use.api': 60,
+}
+# Dependencies that none of the modules above may load.
+HEAVY_DEPENDENCIES = ['absl', 'astunparse', 'rich', 'requests', 'typing_extensions', 'tiktoken', 'transformers', 'torch']
+
+IMPORTTIME_PATTERN = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| (\S+)$")
+
+def measure(module : str) -> Tuple[float, List[str]]:
+  """Imports `module` in a fresh interpreter; returns its cumulative import time in ms and the top-level modules loaded."""
+  process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                            f'import {module}, json, sys; print(json.dumps(sorted(sys.modules)))'],
+                           capture_output=True, text=True, check=True)
+  cumulative = [int(match.group(1)) for match in map(IMPORTTIME_PATTERN.match, process.stderr.splitlines())
+                if match and match.group(2) == module]
+  loaded = sorted({name.split('.')[0] for name in json.loads(process.stdout)})
+  return cumulative[0] / 1000 if cumulative else 0.0, loaded
+
+def check(budgets : Dict[str, float] = BUDGETS, repeats : int = 5) -> List[str]:
+  """Returns a description of every module that is over budget or loads a heavy dependency."""
+  failures = []
+  for module, budget in budgets.items():
+    timings, loaded = zip(*[measure(module) for _ in range(repeats)])
+    heavy = sorted(set(loaded[0]) & set(HEAVY_DEPENDENCIES))
+    print(f"{module:<28} {min(timings):6.1f}ms (budget {budget}ms)" + (f"; loads {', '.join(heavy)}" if heavy else ""))
+    if min(timings) > budget: failures.append(f"{module} imports in {min(timings):.1f}ms, over its {budget}ms budget")
+    if heavy: failures.append(f"{module} loads {', '.join(heavy)}")
+  return failures
+
+if __name__ == '__main__':
+  failures = check()
+  if failures:
+    print('\n'.join(failures), file=sys.stderr)
+    sys.exit(1)
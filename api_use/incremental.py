@@ -0,0 +1,112 @@
+"""Incremental, content-hashed writing of test case files.
+
+Every case is hashed together with the definitions of the synthetic libraries
+it touches. Rewriting a test case file only replaces the cases whose hash
+changed, records the hashes in a `<name>.hashes.json` manifest next to it, and
+appends the added/changed/removed case ids to `<name>.changelog.jsonl`, so
+caches keyed on case ids can be invalidated precisely.
+
+To index existing files without regenerating them:
+
+  python3 -m api_use.incremental testcases/*.json
+"""
+
+import functools
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Set
+
+from . import api
+from . import api_use_tasks
+from . import task
+from . import utils
+
+# Bump whenever generation output changes: any change to api, task, utils or
+# testspec that alters the prompt, target or test of an existing case. Case
+# hashes only cover the cases and their libraries, so without a bump stale
+# entries are reused. Every case is invalidated at once.
+GENERATION_VERSION = 3
+
+def manifest_path(path : str) -> str:
+  return os.path.splitext(path)[0] + '.hashes.json'
+
+def changelog_path(path : str) -> str:
+  return os.path.splitext(path)[0] + '.changelog.jsonl'
+
+@functools.lru_cache(maxsize=None)
+def library_fingerprint(task_id : str) -> str:
+  task_ = task.APITask.get_task(task_id)
+  data = [task_.id, task_.library_name, task_.style, [list(f) for f in task_.functions]]
+  return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def signature_libraries(signature : str) -> Set[str]:
+  """Returns the ids of every library a signature calls into, including through return types."""
+  _, attrs = api.handle_data(api.parse_signature(signature))
+  utils.reset_nonrepeating_ids()
+  return set(attrs['task_id_to_data'])
+
+def case_libraries(case : Dict[str, Any]) -> List[str]:
+  task_ids = set(signature_libraries(case['signature']))
+  for fewshot_case in case.get('fewshot', []):
+    task_ids |= signature_libraries(fewshot_case['signature'])
+  return sorted(task_ids)
+
+def case_hash(case : Dict[str, Any]) -> str:
+  """Hashes a case's generation arguments with the libraries it touches."""
+  libraries = {task_id: library_fingerprint(task_id) for task_id in case_libraries(case)}
+  data = [GENERATION_VERSION, case, libraries]
+  return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def load_case_hashes(path : str) -> Dict[str, str]:
+  """Returns the recorded {case id: hash} manifest for a test case file, if any."""
+  if not os.path.exists(manifest_path(path)): return {}
+  with open(manifest_path(path)) as f:
+    return json.load(f)
+
+def write_test_cases(path : str, cases : Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+  """Writes `cases` to `path`, touching only the cases whose hash changed.
+
+  Returns the changelog entry: the lists of added, changed and removed case ids.
+  If nothing changed, no file is rewritten.
+  """
+  old_cases : Dict[str, Any] = {}
+  if os.path.exists(path):
+    with open(path) as f:
+      old_cases = json.load(f)
+  old_hashes = load_case_hashes(path)
+
+  hashes = {case_id: case_hash(case) for case_id, case in cases.items()}
+
+  def is_changed(case_id):
+    if case_id in old_hashes: return hashes[case_id] != old_hashes[case_id]
+    # Files written before manifests existed are trusted if the arguments match.
+    return cases[case_id] != old_cases[case_id]
+
+  changes : Dict[str, List[str]] = {
+    'added': [case_id for case_id in cases if case_id not in old_cases],
+    'changed': [case_id for case_id in cases if case_id in old_cases and is_changed(case_id)],
+    'removed': [case_id for case_id in old_cases if case_id not in cases],
+  }
+  print(f"{path}: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+        f"{len(changes['removed'])} removed, {len(cases) - len(changes['added']) - len(changes['changed'])} unchanged.")
+  if not any(changes.values()) and old_hashes == hashes: return changes
+
+  stale = set(changes['added']) | set(changes['changed'])
+  output = {case_id: (case if case_id in stale else old_cases[case_id]) for case_id, case in cases.items()}
+  with open(path, 'w') as f:
+    json.dump(output, f, indent=2)
+  with open(manifest_path(path), 'w') as f:
+    json.dump(hashes, f, indent=2)
+  if any(changes.values()):
+    with open(changelog_path(path), 'a') as f:
+      f.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **changes}) + '\n')
+  return changes
+
+if __name__ == '__main__':
+  for path in sys.argv[1:]:
+    with open(path) as f:
+      write_test_cases(path, json.load(f))
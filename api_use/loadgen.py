@@ -0,0 +1,195 @@
+"""A synthetic decode load generator, for stress-testing the scorer.
+
+Decodes are derived from the targets of a suite's test cases, in
+configurable proportions of these kinds:
+
+  correct       the target itself.
+  arg_swap      the target with the first two distinct arguments of a call swapped.
+  wrong_name    the target with its last call renamed to another function.
+  syntax_error  the target with an unbalanced parenthesis.
+  infinite_loop a loop that never ends (must time out).
+  memory_hog    allocations of 10 MB at a time, up to a few times the workers'
+                memory limit (which must be set).
+
+Only `correct` decodes should pass, and infinite loops and memory hogs must
+fail by timing out and by raising a MemoryError at the memory limit,
+respectively; the run exits with an error otherwise. Decodes are scored in subprocess workers
+(or on execution servers, if configured) at a target rate, and the report
+gives throughput, latency percentiles and the fraction of verdicts that
+match the expected ones, per kind:
+
+  python3 -m api_use.loadgen testcases/chaining.json --num_decodes 2000 --rate 200
+"""
+
+import ast
+import collections
+import concurrent.futures
+from dataclasses import dataclass
+import json
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import astunparse
+
+from . import api
+from . import execution
+from . import execution_utils
+from . import task
+
+KINDS = ['correct', 'arg_swap', 'wrong_name', 'syntax_error', 'infinite_loop', 'memory_hog']
+HOG_CHUNK = 10 * 2**20  # bytes allocated at a time by memory_hog decodes
+HOG_FACTOR = 4  # how many times the memory limit memory_hog decodes try to allocate
+# The error text that shows a decode of each kind failed for the right reason.
+EXPECTED_ERRORS = {'infinite_loop': ('not able to complete before the timeout',), 'memory_hog': ('MemoryError',)}
+DEFAULT_MIX = {'correct': 0.4, 'arg_swap': 0.15, 'wrong_name': 0.15, 'syntax_error': 0.1, 'infinite_loop': 0.1, 'memory_hog': 0.1}
+
+@dataclass
+class LoadDecode:
+  test_case_id : str
+  kind : str
+  decode : str
+  expected : bool
+
+  def matches(self, correct : bool, error : Optional[str]) -> bool:
+    """Whether a verdict is the expected one, for the expected reason."""
+    if correct != self.expected: return False
+    reasons = EXPECTED_ERRORS.get(self.kind)
+    return not reasons or any(reason in (error or '') for reason in reasons)
+
+def swap_args(target : str) -> Optional[str]:
+  """Swaps the first two distinct positional arguments of any call in `target`, if there are some."""
+  tree = ast.parse(target[len('return '):])
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Call) and len(node.args) >= 2:
+      a, b = node.args[0], node.args[1]
+      if ast.dump(a) != ast.dump(b):
+        node.args[0], node.args[1] = b, a
+        return 'return ' + astunparse.unparse(tree).strip()
+  return None
+
+def rename_call(target : str, library_id : str, rng : random.Random) -> str:
+  """Renames the outermost call of `target` to another function of the library, or to a made-up one."""
+  tree = ast.parse(target[len('return '):])
+  call = tree.body[0].value  # type: ignore
+  name = call.func.attr
+  options = []
+  if library_id in task.APITask.registry or library_id in task.APITask.factories:
+    options = sorted(func.name for func in task.APITask.get_task(library_id).functions if func.name != name)
+  call.func.attr = rng.choice(options) if options else name + '_v2'
+  return 'return ' + astunparse.unparse(tree).strip()
+
+def make_decode(kind : str, target : str, library_id : str, rng : random.Random, memory_limit : Optional[int] = None) -> Tuple[str, str]:
+  """Returns a decode of the given kind (or of a fallback kind, if `kind` does not apply) and its kind."""
+  if kind == 'arg_swap':
+    swapped = swap_args(target)
+    if swapped is not None: return swapped, kind
+    kind = 'wrong_name'
+  if kind == 'correct':
+    return target, kind
+  elif kind == 'wrong_name':
+    return rename_call(target, library_id, rng), kind
+  elif kind == 'syntax_error':
+    return target + '((', kind
+  elif kind == 'infinite_loop':
+    return 'while True:\n      pass', kind
+  elif kind == 'memory_hog':
+    assert memory_limit, "memory_hog decodes need a worker memory limit."
+    num_chunks = -(-HOG_FACTOR * memory_limit // HOG_CHUNK)
+    return (f'hog = []\n    for _ in range({num_chunks}):\n'
+            f'        hog.append(bytearray({HOG_CHUNK}))\n    ' + target), kind
+  raise ValueError(f"Decode kind {kind} not recognized; options include {KINDS}")
+
+def generate_load(examples : Dict[str, api.TestCase], num_decodes : int, mix : Dict[str, float], seed : int = 0,
+                  memory_limit : Optional[int] = None) -> List[LoadDecode]:
+  """Draws `num_decodes` decodes for random test cases, with kinds in the proportions of `mix`."""
+  rng = random.Random(seed)
+  test_case_ids = list(examples)
+  kinds, weights = zip(*mix.items())
+  load = []
+  for _ in range(num_decodes):
+    test_case_id = rng.choice(test_case_ids)
+    example = examples[test_case_id]
+    decode, kind = make_decode(rng.choices(kinds, weights=weights)[0], example.target, example.test.dummy_name, rng, memory_limit)
+    load.append(LoadDecode(test_case_id, kind, decode, expected=(kind == 'correct')))
+  return load
+
+def percentile(values : List[float], q : float) -> float:
+  values = sorted(values)
+  return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+def run_load(examples : Dict[str, api.TestCase], load : List[LoadDecode], rate : float, concurrency : int, timeout : float) -> Dict[str, Any]:
+  """Scores `load` at `rate` decodes per second (0 for as fast as possible) and reports on it.
+
+  Latencies are measured from each decode's scheduled start, so they include
+  any time spent queueing behind a saturated scorer.
+  """
+  records : List[Tuple[LoadDecode, bool, Optional[str], float]] = []
+  lock = threading.Lock()
+
+  def score(item, scheduled):
+    correct, error = execution.execute(item.decode, examples[item.test_case_id].test, isolation='subprocess', timeout=timeout)
+    with lock:
+      records.append((item, correct, error, time.time() - scheduled))
+
+  start = time.time()
+  with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+    for i, item in enumerate(load):
+      scheduled = start + i / rate if rate else time.time()
+      if scheduled > time.time(): time.sleep(scheduled - time.time())
+      executor.submit(score, item, scheduled)
+  elapsed = time.time() - start
+
+  latencies = [latency for *_, latency in records]
+  by_kind : Dict[str, List[Tuple[bool, Optional[str]]]] = collections.defaultdict(list)
+  for item, correct, error, _ in records:
+    by_kind[item.kind].append((item.matches(correct, error), error))
+  return {
+    'decodes': len(records),
+    'elapsed': elapsed,
+    'throughput': len(records) / elapsed,
+    'latency': {f'p{int(q * 100)}': percentile(latencies, q) for q in (0.5, 0.9, 0.99)} | {'max': max(latencies, default=0.0)},
+    'verdict_accuracy': sum(matched for results in by_kind.values() for matched, _ in results) / max(len(records), 1),
+    'kinds': {kind: {'count': len(results),
+                     'verdict_accuracy': sum(matched for matched, _ in results) / len(results),
+                     'timeouts': sum(bool(error) and 'timeout' in error for _, error in results),
+                     'memory_errors': sum(bool(error) and 'MemoryError' in error for _, error in results),
+                     'worker_exits': sum(bool(error) and 'worker process exited' in error for _, error in results)}
+              for kind, results in sorted(by_kind.items())},
+  }
+
+if __name__ == '__main__':
+  import sys
+
+  from absl import app
+  from absl import flags
+
+  from . import api_use_tasks
+
+  flags.DEFINE_integer('num_decodes', 1000, 'The number of decodes to score.')
+  flags.DEFINE_list('mix', [f'{kind}={weight}' for kind, weight in DEFAULT_MIX.items()], 'The proportion of each decode kind.')
+  flags.DEFINE_float('rate', 0, 'The target number of decodes submitted per second (0 for as fast as possible).')
+  flags.DEFINE_integer('concurrency', 8, 'The number of decodes scored at once.')
+  flags.DEFINE_integer('num_workers', 8, 'The number of scoring subprocesses.')
+  flags.DEFINE_integer('memory_limit_mb', 1024, 'The address space limit of each scoring subprocess (0 for none).')
+  flags.DEFINE_float('timeout', 2, 'The per-decode timeout, in seconds.')
+  flags.DEFINE_integer('seed', 0, 'The random seed of the decode stream.')
+  FLAGS = flags.FLAGS
+
+  def main(argv):
+    assert len(argv) > 1, "Path to a test case file must be provided!"
+    with open(argv[1]) as f:
+      examples = api.get_examples(json.load(f))
+    mix = {kind: float(weight) for kind, weight in (item.split('=') for item in FLAGS.mix)}
+    memory_limit = FLAGS.memory_limit_mb * 2**20 or None
+    execution_utils.get_worker_pool(FLAGS.num_workers, memory_limit)
+    load = generate_load(examples, FLAGS.num_decodes, mix, FLAGS.seed, memory_limit)
+    report = run_load(examples, load, FLAGS.rate, FLAGS.concurrency, FLAGS.timeout)
+    print(json.dumps(report, indent=2))
+    mismatched = {kind: stats['count'] - round(stats['verdict_accuracy'] * stats['count'])
+                  for kind, stats in report['kinds'].items() if stats['verdict_accuracy'] < 1}
+    if mismatched:
+      sys.exit(f"Unexpected verdicts, or expected ones for the wrong reason: {mismatched}")
+
+  app.run(main)
@@ -0,0 +1,95 @@
+"""Readers for the files `evaluate.py` writes into an experiment directory."""
+
+from dataclasses import dataclass
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+RULE = '-' * 80 + '\n'
+
+@dataclass
+class SummaryRow:
+  test_case_id : str
+  accuracy : float
+  correct : int
+  total : int
+  latency : float
+  # The seconds of sampling and scoring attributed to this case alone, so that
+  # the costs of a run's cases sum to its time; absent from older summaries.
+  cost : Optional[float] = None
+
+@dataclass
+class CaseResult:
+  test_case_id : str
+  test_case : Dict[str, Any]
+  prompt : str
+  decodes : List[str]
+  outputs : List[Tuple[bool, Optional[str]]]
+  num_requested : Optional[int] = None
+
+  @property
+  def correct(self) -> int:
+    return sum(output[0] for output in self.outputs)
+
+def parse_summary_line(line : str) -> SummaryRow:
+  test_case_id, accuracy, fraction, latency, *rest = line.rstrip('\n').split('\t')
+  correct, total = fraction.split('/')
+  cost = float(rest[0].rstrip('s')) if rest else None
+  return SummaryRow(test_case_id, float(accuracy), int(correct), int(total), float(latency.rstrip('s')), cost)
+
+def read_summary(experiment_dir : str, filename : str = 'summary.txt') -> Dict[str, SummaryRow]:
+  """Returns the rows of an experiment's summary file, keyed by test case id."""
+  rows = {}
+  with open(os.path.join(experiment_dir, filename)) as f:
+    for line in f:
+      if line.strip():
+        row = parse_summary_line(line)
+        rows[row.test_case_id] = row
+  return rows
+
+def decodes_path(experiment_dir : str, test_case_id : str) -> str:
+  return os.path.join(experiment_dir, test_case_id + '.decodes')
+
+def parse_decodes(test_case_id : str, text : str) -> CaseResult:
+  """Parses the contents of a `.decodes` file."""
+  test_case, end = json.JSONDecoder().raw_decode(text)
+  parts = text[end:].split(RULE)
+  header = parts[0].lstrip('\n')
+  num_requested = None
+  if header.startswith('Decodes used:'):
+    num_requested = int(header[:header.index('\n')].split('/')[-1])
+    header = header[header.index('\n') + 1:]
+  prompt = header[len('Prompt: '):-1]
+
+  decodes, outputs = [], []
+  for i in range(1, len(parts) - 1, 3):
+    verdict, decode = parts[i], parts[i+1]
+    correct_line, error = verdict[:-1].split('\n', 1)
+    error = error[len('Error: '):]
+    outputs.append((correct_line == 'Correct: True', None if error == 'None' else error))
+    decodes.append(decode[:-1])
+  return CaseResult(test_case_id, test_case, prompt, decodes, outputs, num_requested)
+
+def format_summary_line(test_case_id : str, correct : int, total : int, latency : float, cost : Optional[float] = None) -> str:
+  line = f'{test_case_id}\t{correct / total:.3f}\t{correct}/{total}\t{latency:.4f}s'
+  return line + (f'\t{cost:.4f}s' if cost is not None else '')
+
+def format_decodes(test_case : Dict[str, Any], prompt : str, decodes : List[str],
+                   outputs : List[Tuple[bool, Optional[str]]], num_requested : int) -> str:
+  """The contents of a `.decodes` file; the inverse of `parse_decodes`."""
+  parts = [json.dumps(test_case, indent=2) + '\n',
+           f"Decodes used: {len(decodes)}/{num_requested}\n",
+           "Prompt: " + prompt + '\n']
+  for (decode, result) in zip(decodes, outputs):
+    parts += [RULE, 'Correct: ' + str(result[0]) + '\n', 'Error: ' + str(result[1]) + '\n', RULE, str(decode) + '\n', RULE]
+  return ''.join(parts)
+
+def read_decodes(experiment_dir : str, test_case_id : str) -> CaseResult:
+  with open(decodes_path(experiment_dir, test_case_id)) as f:
+    return parse_decodes(test_case_id, f.read())
+
+def iter_decodes(experiment_dir : str) -> Iterator[CaseResult]:
+  """Yields every case result stored in an experiment directory, in summary order."""
+  for test_case_id in read_summary(experiment_dir):
+    if os.path.exists(decodes_path(experiment_dir, test_case_id)):
+      yield read_decodes(experiment_dir, test_case_id)
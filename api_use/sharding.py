@@ -0,0 +1,141 @@
+"""Deterministic sharding of a suite across workers, balanced by estimated cost.
+
+A case's cost is estimated by a linear `CostModel` over its features: its
+prompt length in tokens, the number of decodes, and the number of decodes
+times the depth of the call chain in its signature (which is what scoring
+costs). A per-library scale is applied on top. The default weights only rank
+cases; `fit_cost_model` refines them, and the library scales, from the
+per-case costs in earlier runs' summaries: each case's share of its batch's
+sampling time plus its group's scoring time, split among the cases that share
+a prompt (see `evaluate.py`), so that no second is counted twice.
+
+`assign_shards` then schedules cases longest first, each onto the currently
+least loaded shard, breaking ties by case id and shard index, so that every
+worker computes the same assignment independently:
+
+  python3 evaluate.py --num_shards 8 --shard_index 3 --timings_from runs/ABC123 ...
+"""
+
+from dataclasses import dataclass, field
+import functools
+import heapq
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from . import api
+from . import task
+from . import tokens
+from . import utils
+
+FEATURES = ('constant', 'prompt_tokens', 'decodes', 'decode_calls')
+
+@dataclass(frozen=True)
+class CaseFeatures:
+  library_id : str
+  prompt_tokens : float
+  decodes : int
+  chain_depth : int
+
+  def vector(self) -> Tuple[float, ...]:
+    return (1.0, self.prompt_tokens, float(self.decodes), float(self.decodes * self.chain_depth))
+
+@dataclass
+class CostModel:
+  weights : Tuple[float, ...] = (0.5, 0.001, 0.02, 0.005)
+  library_scales : Dict[str, float] = field(default_factory=dict)
+
+  def cost(self, features : CaseFeatures) -> float:
+    base = sum(w * x for w, x in zip(self.weights, features.vector()))
+    return base * self.library_scales.get(features.library_id, 1.0)
+
+def call_chain(signature : str) -> Tuple[str, int]:
+  """Returns the library a signature starts from and the number of calls in its chain."""
+  node = api.parse_signature(signature)
+  depth = 0
+  while hasattr(node, 'func'):
+    depth += 1
+    node = node.func.value  # type: ignore
+  return getattr(node, 'id', ''), depth
+
+@functools.lru_cache(maxsize=None)
+def mean_function_tokens(library_id : str) -> float:
+  """The mean token count of a library's rendered functions."""
+  try:
+    functions = task.APITask.get_task(library_id).functions
+  except KeyError:
+    return 0.0
+  return sum(tokens.count_tokens(utils.render_function(func, '    ', False)) for func in functions) / max(len(functions), 1)
+
+def estimate_prompt_tokens(test_case : Mapping[str, Any]) -> float:
+  """The rough token count of a case's prompt, from the number of functions and descriptions it shows."""
+  library_id, depth = call_chain(test_case['signature'])
+  num_functions = depth + test_case.get('num_distractors', 0)
+  num_descriptions = 1
+  for shot in test_case.get('fewshot', []):
+    num_functions += call_chain(shot['signature'])[1]
+    num_descriptions += 1
+  return num_functions * mean_function_tokens(library_id) + num_descriptions * tokens.count_tokens(test_case['description'])
+
+def case_features(test_case : Mapping[str, Any], num_decodes : int, prompt : Optional[str] = None) -> CaseFeatures:
+  """A case's features; the prompt's exact length is used if it is given, and estimated otherwise."""
+  library_id, depth = call_chain(test_case['signature'])
+  prompt_tokens = tokens.count_tokens(prompt) if prompt is not None else estimate_prompt_tokens(test_case)
+  return CaseFeatures(library_id, prompt_tokens, num_decodes, depth)
+
+def solve(a : List[List[float]], b : List[float]) -> Optional[List[float]]:
+  """Solves a small linear system by Gaussian elimination; returns None if it is singular."""
+  n = len(b)
+  m = [row[:] + [b[i]] for i, row in enumerate(a)]
+  for col in range(n):
+    pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+    if abs(m[pivot][col]) < 1e-12: return None
+    m[col], m[pivot] = m[pivot], m[col]
+    for r in range(n):
+      if r != col:
+        factor = m[r][col] / m[col][col]
+        m[r] = [x - factor * y for x, y in zip(m[r], m[col])]
+  return [m[i][n] / m[i][i] for i in range(n)]
+
+def fit_cost_model(samples : Sequence[Tuple[CaseFeatures, float]],
+                   prior : CostModel = CostModel(),
+                   min_library_samples : int = 5) -> CostModel:
+  """Fits the weights to (features, seconds) samples by least squares, then the per-library scales.
+
+  Features are scaled to unit mean and lightly ridge-regularized, and
+  negative weights are clipped to zero. Without enough samples for a fit, the
+  prior's weights are only rescaled to the observed total.
+  """
+  if not samples: return prior
+  vectors = [features.vector() for features, _ in samples]
+  seconds = [s for _, s in samples]
+  scales = [sum(abs(v[i]) for v in vectors) / len(vectors) or 1.0 for i in range(len(FEATURES))]
+  x = [[v[i] / scales[i] for i in range(len(FEATURES))] for v in vectors]
+  gram = [[sum(row[i] * row[j] for row in x) + (1e-3 * len(x) if i == j else 0.0) for j in range(len(FEATURES))] for i in range(len(FEATURES))]
+  moments = [sum(row[i] * s for row, s in zip(x, seconds)) for i in range(len(FEATURES))]
+  solution = solve(gram, moments) if len(samples) > len(FEATURES) else None
+  if solution is not None and any(w > 0 for w in solution):
+    weights = tuple(max(w, 0.0) / scale for w, scale in zip(solution, scales))
+  else:
+    predicted = sum(CostModel(prior.weights).cost(features) for features, _ in samples)
+    weights = tuple(w * sum(seconds) / max(predicted, 1e-12) for w in prior.weights)
+
+  model = CostModel(weights)
+  observed : Dict[str, List[float]] = {}
+  for features, s in samples:
+    totals = observed.setdefault(features.library_id, [0.0, 0.0, 0])
+    totals[0] += s
+    totals[1] += model.cost(features)
+    totals[2] += 1
+  model.library_scales = {library_id: observed_seconds / predicted
+                          for library_id, (observed_seconds, predicted, count) in observed.items()
+                          if count >= min_library_samples and predicted > 0}
+  return model
+
+def assign_shards(costs : Mapping[str, float], num_shards : int) -> List[List[str]]:
+  """Longest-processing-time scheduling of cases onto `num_shards` shards; returns each shard's case ids."""
+  shards : List[List[str]] = [[] for _ in range(num_shards)]
+  loads = [(0.0, i) for i in range(num_shards)]
+  for test_case_id in sorted(costs, key=lambda test_case_id: (-costs[test_case_id], test_case_id)):
+    load, i = heapq.heappop(loads)
+    shards[i].append(test_case_id)
+    heapq.heappush(loads, (load + costs[test_case_id], i))
+  return shards
@@ -0,0 +1,30 @@
+"""Small statistics helpers for summarizing per-case accuracies."""
+
+import math
+from typing import Tuple
+
+def wilson_interval(correct : int, total : int, z : float = 1.96) -> Tuple[float, float]:
+  """Returns the Wilson score interval for `correct` successes out of `total` trials.
+
+  Unlike the normal approximation, the interval stays well-behaved at 0% and
+  100% accuracy, which is exactly where saturated test cases sit.
+  """
+  if total == 0: return 0.0, 1.0
+  p = correct / total
+  denominator = 1 + z * z / total
+  center = (p + z * z / (2 * total)) / denominator
+  margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominator
+  return max(0.0, center - margin), min(1.0, center + margin)
+
+def two_proportion_test(correct_a : int, total_a : int, correct_b : int, total_b : int) -> Tuple[float, float]:
+  """Returns the z statistic and two-sided p-value of a pooled two-proportion z-test.
+
+  z is positive when b is the more accurate. Degenerate inputs (no trials, or
+  every trial in both samples with the same outcome) give z = 0 and p = 1.
+  """
+  if total_a == 0 or total_b == 0: return 0.0, 1.0
+  pooled = (correct_a + correct_b) / (total_a + total_b)
+  se = math.sqrt(pooled * (1 - pooled) * (1 / total_a + 1 / total_b))
+  if se == 0: return 0.0, 1.0
+  z = (correct_b / total_b - correct_a / total_a) / se
+  return z, math.erfc(abs(z) / math.sqrt(2))
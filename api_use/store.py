@@ -0,0 +1,177 @@
+"""A memory-mapped store of materialized test cases.
+
+`materialize` generates every case of a suite once and writes its prompt,
+target, test and metadata into a single file. Strings are stored once per
+distinct content (so e.g. a function list or few-shot example shared by many
+prompts is stored once) and prompts are stored as a list of such segments.
+Reading a store only needs this module and `testspec`: no library registry or
+prompt generation is imported, and every process that opens the same file
+shares its pages through the OS page cache.
+
+  python3 -m api_use.store materialize testcases/chaining.json chaining.apistore [--max_prompt_tokens 512]
+  python3 -m api_use.store show chaining.apistore <case id>
+
+File layout: an 8-byte magic, the 8-byte little-endian offset of the index,
+the blob area, and the index as JSON:
+
+  {"blobs": [[offset, length], ...],
+   "cases": {case_id: [prompt blob ids, target blob, test blob, metadata blob, hash]}}
+"""
+
+from dataclasses import dataclass
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Any, Dict, Iterator, List, Optional
+
+from . import testspec
+
+MAGIC = b'APISTOR1'
+HEADER = struct.Struct('<8sQ')
+
+@dataclass
+class StoredCase:
+  prompt : str
+  target : str
+  test : testspec.TestSpec
+  metadata : Dict[str, Any]
+  hash : Optional[str]
+
+
+class StoreWriter:
+  """Writes blobs to a store file, deduplicating them by content hash."""
+
+  def __init__(self, path : str):
+    self.path = path
+    self.f = open(path + '.tmp', 'wb')
+    self.f.write(HEADER.pack(MAGIC, 0))
+    self.blobs : List[List[int]] = []
+    self.blob_ids : Dict[bytes, int] = {}
+    self.cases : Dict[str, List[Any]] = {}
+
+  def add_blob(self, text : str) -> int:
+    data = text.encode()
+    digest = hashlib.sha1(data).digest()
+    if digest not in self.blob_ids:
+      self.blob_ids[digest] = len(self.blobs)
+      self.blobs.append([self.f.tell(), len(data)])
+      self.f.write(data)
+    return self.blob_ids[digest]
+
+  def add_case(self, case_id : str, prompt_segments : List[str], target : str, test : testspec.TestSpec,
+               metadata : Dict[str, Any], case_hash : Optional[str] = None):
+    self.cases[case_id] = [[self.add_blob(segment) for segment in prompt_segments],
+                           self.add_blob(target),
+                           self.add_blob(test.to_json()),
+                           self.add_blob(json.dumps(metadata)),
+                           case_hash]
+
+  def close(self):
+    index_offset = self.f.tell()
+    self.f.write(json.dumps({'blobs': self.blobs, 'cases': self.cases}, separators=(',', ':')).encode())
+    self.f.seek(0)
+    self.f.write(HEADER.pack(MAGIC, index_offset))
+    self.f.close()
+    os.replace(self.path + '.tmp', self.path)
+
+
+class PromptStore:
+  """Read-only, memory-mapped access to a materialized suite.
+
+  Cases are looked up by id in O(1). `prompt_bytes` returns zero-copy
+  memoryviews into the mapped file; `store[case_id]` decodes a `StoredCase`.
+  """
+
+  def __init__(self, path : str):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, index_offset = HEADER.unpack_from(self.mm, 0)
+    assert magic == MAGIC, f"{path} is not a prompt store."
+    index = json.loads(self.mm[index_offset:])
+    self.blobs : List[List[int]] = index['blobs']
+    self.cases : Dict[str, List[Any]] = index['cases']
+
+  def blob(self, blob_id : int) -> memoryview:
+    offset, length = self.blobs[blob_id]
+    return memoryview(self.mm)[offset:offset + length]
+
+  def text(self, blob_id : int) -> str:
+    return str(self.blob(blob_id), 'utf-8')
+
+  def prompt_bytes(self, case_id : str) -> List[memoryview]:
+    return [self.blob(blob_id) for blob_id in self.cases[case_id][0]]
+
+  def metadata(self, case_id : str) -> Dict[str, Any]:
+    return json.loads(self.text(self.cases[case_id][3]))
+
+  def __getitem__(self, case_id : str) -> StoredCase:
+    prompt_ids, target_id, test_id, metadata_id, case_hash = self.cases[case_id]
+    return StoredCase(prompt=''.join(self.text(blob_id) for blob_id in prompt_ids),
+                      target=self.text(target_id),
+                      test=testspec.TestSpec.from_json(self.text(test_id)),
+                      metadata=json.loads(self.text(metadata_id)),
+                      hash=case_hash)
+
+  def __contains__(self, case_id : str) -> bool:
+    return case_id in self.cases
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self.cases)
+
+  def __len__(self) -> int:
+    return len(self.cases)
+
+  def close(self):
+    self.mm.close()
+
+
+def materialize(test_cases : Dict[str, Dict[str, Any]], path : str):
+  """Generates every test case once and writes the results to a store at `path`."""
+  from . import api
+  from . import api_use_tasks
+  from . import incremental
+
+  writer = StoreWriter(path)
+  for case_id, results in api.get_data_for_test_cases(test_cases).items():
+    case = test_cases[case_id]
+    writer.add_case(case_id,
+                    prompt_segments=results['prompt_segments'],
+                    target='return ' + results['target'],
+                    test=results['test'],
+                    metadata=case,
+                    case_hash=incremental.case_hash(case))
+  writer.close()
+  print(f"{path}: materialized {len(writer.cases)} cases into {len(writer.blobs)} distinct blobs.")
+
+if __name__ == '__main__':
+  from absl import app
+  from absl import flags
+
+  flags.DEFINE_integer('max_prompt_tokens', None, 'materialize: drop distractors or few-shot examples from prompts longer than this many tokens')
+  flags.DEFINE_string('tokenizer', 'approx', 'materialize: the offline tokenizer prompts are measured with')
+  flags.DEFINE_enum('budget_policy', 'distractors_then_shots', ['distractors_then_shots', 'shots_then_distractors', 'drop_distractors', 'drop_shots', 'error'],
+                    'materialize: what to drop from prompts over --max_prompt_tokens')
+  FLAGS = flags.FLAGS
+
+  def main(argv):
+    command, *args = argv[1:]
+    if command == 'materialize':
+      test_cases_path, store_path = args
+      with open(test_cases_path) as f:
+        test_cases = json.load(f)
+      if FLAGS.max_prompt_tokens is not None:
+        # as `evaluate.py` does for unmaterialized suites
+        budget = {'max_prompt_tokens': FLAGS.max_prompt_tokens, 'tokenizer': FLAGS.tokenizer, 'budget_policy': FLAGS.budget_policy}
+        test_cases = {case_id: {**case, **budget} for case_id, case in test_cases.items()}
+      materialize(test_cases, store_path)
+    elif command == 'show':
+      store_path, case_id = args
+      stored = PromptStore(store_path)[case_id]
+      print(stored.prompt + '\n' + stored.target + '\n\n' + str(stored.test))
+    else:
+      raise ValueError(f"Command {command} not recognized.")
+
+  app.run(main)
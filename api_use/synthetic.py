@@ -0,0 +1,197 @@
+"""Procedurally generated libraries, for testing how generation and scoring scale.
+
+`register_libraries(spec)` registers `spec.num_libraries` libraries named
+`<prefix>0`, `<prefix>1`, ... of `spec.num_functions` functions each. Nothing
+is built until a library is first requested with `task.APITask.get_task`, and
+each library is then built from a deterministic stream of function rows.
+
+Arities are drawn from `spec.arity_weights`. A `spec.chain_probability`
+fraction of functions return an object of another library, following a
+return-type graph in which each library links to `spec.out_degree` others, so
+that call chains of any length can be sampled with `sample_call_chain`. The
+rest return a scalar. Documentation is filled in from `spec.doc_templates`, using the
+`[description|arg]` markup of the bundled libraries.
+
+To time prompt generation and scoring on a large suite:
+
+  python3 -m api_use.synthetic --num_functions 10000 --num_cases 100 --num_distractors 50
+"""
+
+from dataclasses import dataclass
+import functools
+import json
+import random
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+from . import task
+from . import utils
+
+VERBS = ["compute", "get", "normalize", "merge", "split", "rank", "filter", "encode", "decode", "resize",
+         "validate", "render", "index", "sample", "project", "reduce", "expand", "align", "score", "shift"]
+NOUNS = ["record", "vector", "matrix", "frame", "token", "signal", "graph", "node", "edge", "batch",
+         "window", "buffer", "segment", "layer", "channel", "bucket", "cluster", "range", "query", "table"]
+ARGS = ["count", "size", "offset", "scale", "limit", "key", "value", "index", "width", "depth",
+        "level", "rate", "mode", "label", "threshold", "weight", "seed", "axis", "step", "margin"]
+SCALAR_TYPES = ["float", "int", "str", "bool"]
+# Templates may use {verb}, {noun}, {library}, {args} and {returns}.
+DOC_TEMPLATES = (
+  "Applies {verb} to the {noun}{args}, and returns {returns}.",
+  "Returns {returns}, obtained by applying {verb} to the {noun}{args}.",
+  "Runs {verb} over every {noun} in the {library}{args}. Returns {returns}.",
+)
+
+@dataclass(frozen=True)
+class LibrarySpec:
+  prefix : str = 'synth'
+  num_libraries : int = 4
+  num_functions : int = 10000
+  arity_weights : Tuple[float, ...] = (0.2, 0.35, 0.25, 0.15, 0.05)
+  chain_probability : float = 0.3
+  out_degree : int = 2
+  style : str = 'class'
+  doc_templates : Tuple[str, ...] = DOC_TEMPLATES
+  seed : int = 0
+
+  def library_id(self, index : int) -> str:
+    return f"{self.prefix}{index}"
+
+def return_type_graph(spec : LibrarySpec) -> Dict[str, List[str]]:
+  """The libraries whose objects each library's functions can return."""
+  graph = {}
+  for index in range(spec.num_libraries):
+    others = [spec.library_id(i) for i in range(spec.num_libraries) if i != index]
+    graph[spec.library_id(index)] = random.Random(f"{spec.seed}:graph:{index}").sample(others, k=min(spec.out_degree, len(others)))
+  return graph
+
+def function_name(i : int) -> str:
+  verb, noun = VERBS[i % len(VERBS)], NOUNS[(i // len(VERBS)) % len(NOUNS)]
+  repeat = i // (len(VERBS) * len(NOUNS))
+  return f"{verb}_{noun}" + (f"_{repeat}" if repeat else "")
+
+def iter_function_rows(spec : LibrarySpec, index : int) -> Iterator[List[Any]]:
+  """Yields the `[name, documentation, arglist, return_type]` rows of a library, one at a time."""
+  rng = random.Random(f"{spec.seed}:library:{index}")
+  library_id = spec.library_id(index)
+  chain_types = return_type_graph(spec)[library_id]
+  for i in range(spec.num_functions):
+    name = function_name(i)
+    arity = rng.choices(range(len(spec.arity_weights)), weights=spec.arity_weights)[0]
+    arglist = rng.sample(ARGS, k=arity)
+    if chain_types and rng.random() < spec.chain_probability:
+      return_type = rng.choice(chain_types)
+      returns = f"the resulting {return_type}"
+    else:
+      return_type = rng.choice(SCALAR_TYPES)
+      returns = utils.an(return_type)
+    verb, noun = name.split('_')[:2]
+    args = (" with " + utils.andjoin(f"[{utils.spacify(arg)}|{arg}]" for arg in arglist)) if arglist else ""
+    documentation = rng.choice(spec.doc_templates).format(verb=verb, noun=noun, library=library_id, args=args, returns=returns)
+    yield [name, documentation, arglist, return_type]
+
+def build_library(spec : LibrarySpec, index : int) -> task.APITask:
+  return task.APITask(id=spec.library_id(index),
+                      library_name=spec.library_id(index),
+                      functions=iter_function_rows(spec, index),
+                      style=spec.style)
+
+def register_libraries(spec : LibrarySpec) -> List[str]:
+  """Registers lazily built libraries; returns their ids."""
+  library_ids = []
+  for index in range(spec.num_libraries):
+    task.APITask.add_factory(spec.library_id(index), lambda index=index: build_library(spec, index))
+    library_ids.append(spec.library_id(index))
+  return library_ids
+
+@functools.lru_cache(maxsize=None)
+def functions_by_kind(library_id : str) -> Tuple[Tuple[task.Function, ...], Tuple[task.Function, ...]]:
+  """A library's chainable functions (which return another library's object) and its scalar ones."""
+  functions = task.APITask.get_task(library_id).functions
+  return (tuple(func for func in functions if func.return_type not in SCALAR_TYPES),
+          tuple(func for func in functions if func.return_type in SCALAR_TYPES))
+
+def sample_call_chain(spec : LibrarySpec, length : int, rng : random.Random) -> List[task.Function]:
+  """Samples a chain of `length` calls that follows the return-type graph."""
+  library_id = spec.library_id(rng.randrange(spec.num_libraries))
+  chain : List[task.Function] = []
+  for position in range(length):
+    chainable = position < length - 1
+    functions = functions_by_kind(library_id)[0 if chainable else 1]
+    if not functions:
+      raise ValueError(f"Library {library_id} has no {'chainable' if chainable else 'scalar'} functions "
+                       f"for call {position + 1} of a chain of length {length}.")
+    func = rng.choice(functions)
+    chain.append(func)
+    library_id = func.return_type
+  return chain
+
+def sample_test_cases(spec : LibrarySpec,
+                      num_cases : int,
+                      chain_length : int = 1,
+                      num_distractors : int = 0,
+                      seed : int = 0) -> Dict[str, Dict[str, Any]]:
+  """Samples test cases in the format of the files in `testcases/`."""
+  rng = random.Random(f"{spec.seed}:cases:{seed}")
+  test_cases = {}
+  for i in range(num_cases):
+    chain = sample_call_chain(spec, chain_length, rng)
+    signature = chain[0].library_name + ''.join(f".{func.name}()" for func in chain)
+    test_cases[f"{spec.prefix}_{chain_length}_{i}"] = {
+      "signature": signature,
+      "description": ", then ".join(utils.spacify(func.name) for func in chain),
+      "func_name": "_then_".join(func.name for func in chain),
+      "num_distractors": num_distractors,
+    }
+  return test_cases
+
+if __name__ == '__main__':
+  from absl import app
+  from absl import flags
+
+  from . import api
+  from . import execution
+
+  flags.DEFINE_string('prefix', 'synth', 'The prefix of the library ids.')
+  flags.DEFINE_integer('num_libraries', 4, 'The number of libraries.')
+  flags.DEFINE_integer('num_functions', 10000, 'The number of functions per library.')
+  flags.DEFINE_list('arity_weights', ['0.2', '0.35', '0.25', '0.15', '0.05'], 'The relative frequency of each arity, from 0 upwards.')
+  flags.DEFINE_float('chain_probability', 0.3, 'The fraction of functions that return another library\'s object.')
+  flags.DEFINE_integer('out_degree', 2, 'The number of libraries each library\'s functions can return.')
+  flags.DEFINE_multi_string('doc_template', list(DOC_TEMPLATES), 'A template for the documentation of functions; may be repeated.')
+  flags.DEFINE_integer('num_cases', 100, 'The number of test cases to generate.')
+  flags.DEFINE_integer('chain_length', 2, 'The number of calls in each test case.')
+  flags.DEFINE_integer('num_distractors', 50, 'The number of distractors in each prompt.')
+  flags.DEFINE_string('output_path', '', 'If given, the test cases are also written here.')
+  FLAGS = flags.FLAGS
+
+  def main(argv):
+    spec = LibrarySpec(prefix=FLAGS.prefix,
+                       num_libraries=FLAGS.num_libraries,
+                       num_functions=FLAGS.num_functions,
+                       arity_weights=tuple(float(w) for w in FLAGS.arity_weights),
+                       chain_probability=FLAGS.chain_probability,
+                       out_degree=FLAGS.out_degree,
+                       doc_templates=tuple(FLAGS.doc_template))
+    register_libraries(spec)
+
+    start = time.time()
+    test_cases = sample_test_cases(spec, FLAGS.num_cases, FLAGS.chain_length, FLAGS.num_distractors)
+    print(f"Built libraries and sampled {len(test_cases)} cases in {time.time() - start:.2f}s.")
+    if FLAGS.output_path:
+      with open(FLAGS.output_path, 'w') as f:
+        json.dump(test_cases, f, indent=2)
+
+    start = time.time()
+    examples = api.get_examples(test_cases)
+    generation_time = time.time() - start
+    print(f"Generated {len(examples)} prompts in {generation_time:.2f}s "
+          f"({1000 * generation_time / len(examples):.2f}ms per case, "
+          f"{sum(len(example.prompt) for example in examples.values()) / len(examples):.0f} characters per prompt).")
+
+    start = time.time()
+    num_correct = sum(execution.execute(example.target, example.test)[0] for example in examples.values())
+    scoring_time = time.time() - start
+    print(f"Scored the {len(examples)} targets in {scoring_time:.2f}s "
+          f"({1000 * scoring_time / len(examples):.2f}ms per case); {num_correct} passed.")
+
+  app.run(main)
@@ -1,19 +1,44 @@
-from collections import namedtuple
+from collections import Counter, namedtuple
+import collections.abc
 from dataclasses import dataclass
 import json
 import random
 import time
-from typing import Any, Callable, Dict, List, Optional
+from typing import AbstractSet, Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
 
 Function = namedtuple("Function", ("name", "definition", "args", "return_type", "library_name"))
 
+class Distractors(collections.abc.Set):
+  """A read-only view of a library's functions, less a target, in O(1) space."""
+
+  def __init__(self, functions : FrozenSet[Function], target : Function):
+    self.functions = functions
+    self.target = target
+
+  def __contains__(self, func) -> bool:
+    return func != self.target and func in self.functions
+
+  def __iter__(self) -> Iterator[Function]:
+    return (func for func in self.functions if func != self.target)
+
+  def __len__(self) -> int:
+    return len(self.functions) - 1
+
+  @classmethod
+  def _from_iterable(cls, it):
+    return frozenset(it)
+
+  def __repr__(self):
+    return f"Distractors({len(self)} functions, less {self.target.name})"
+
 class APITask:
   registry : Dict[str, Any] = dict()
+  factories : Dict[str, Callable[[], "APITask"]] = dict()
 
   def __init__(self,
                id : str,
                library_name : str,
-               functions: List[List[str]],
+               functions: Iterable[List[Any]],
                style : str = "class"):
     """
     library_name: str (e.g. solids)
@@ -27,6 +52,26 @@ class APITask:
     self.num_distractors : int = -1
     self.do_import = False if style == 'class' else True
 
+  @property
+  def functions(self) -> List[Function]:
+    return self._functions
+
+  @functions.setter
+  def functions(self, functions : List[Function]):
+    self._functions = functions
+    self._index = None
+
+  def function_index(self) -> Tuple[FrozenSet[Function], Dict[str, Function], FrozenSet[str]]:
+    """The library's functions, a map from their names to them, and the names used more than once.
+
+    Built on first use and again whenever `functions` is reassigned.
+    """
+    if self._index is None:
+      counts = Counter(func.name for func in self.functions)
+      self._index = (frozenset(self.functions), {func.name: func for func in self.functions},
+                     frozenset(name for name, count in counts.items() if count > 1))
+    return self._index
+
   @classmethod
   def add_to_registry(cls, id, *args, **kwargs):
     task = cls(id, *args, **kwargs)
@@ -42,17 +87,27 @@ class APITask:
 
     cls.registry[data['id']] = task
 
+  @classmethod
+  def add_factory(cls, id, factory : Callable[[], "APITask"]):
+    """Registers a task that is only built the first time it is requested."""
+    cls.factories[id] = factory
+
   @classmethod
   def get_task(cls, id):
+    if id not in cls.registry and id not in cls.factories:
+      # The bundled libraries are only registered once one is needed.
+      from . import api_use_tasks  # pylint: disable=unused-import,import-outside-toplevel
+    if id not in cls.registry and id in cls.factories:
+      cls.registry[id] = cls.factories.pop(id)()
     return cls.registry[id]
 
-  def generate_priming(self, target_func_name : str):
-    """Returns the data for a target function, as well as all other feasible distractor functions."""
+  def generate_priming(self, target_func_name : str) -> Tuple[AbstractSet[Function], Function]:
+    """Returns the data for a target function, as well as all other feasible distractor functions.
 
-    target_func_defs = [func for func in self.functions if func.name == target_func_name]
-    assert len(target_func_defs) > 0, f"No matching functions found for {target_func_name}; options include {[f.name for f in self.functions]}"
-    assert len(target_func_defs) <= 1, f"Too many matching functions found for {target_func_name}"
-    target_func_def = target_func_defs[0]
-
-    funcs = [func for func in self.functions if func.name != target_func_name]
-    return funcs, target_func_def
+    The distractors are a view of the library's functions rather than a copy.
+    """
+    functions, by_name, duplicates = self.function_index()
+    assert target_func_name in by_name, f"No matching functions found for {target_func_name}; options include {[f.name for f in self.functions]}"
+    assert target_func_name not in duplicates, f"Too many matching functions found for {target_func_name}"
+    target_func_def = by_name[target_func_name]
+    return Distractors(functions, target_func_def), target_func_def
@@ -0,0 +1,85 @@
+"""Structured tests: everything `execution.execute` needs to score a decode."""
+
+from dataclasses import asdict, dataclass
+import functools
+import json
+from typing import Any, Dict, Union
+
+@dataclass(frozen=True)
+class TestSpec:
+  """A test for a generated problem.
+
+  signature: the definition line of the function to be completed, e.g.
+    `def func(radius, height):`.
+  indent: the indent of the function body.
+  dummy_name: the name of the library object the decode calls into.
+  style: 'import_style' or 'class_style'.
+  test_call: the call to the completed function, with dummy arguments.
+  target_call: the reference call chain the result is compared against.
+  """
+  signature : str
+  indent : str
+  dummy_name : str
+  style : str
+  test_call : str
+  target_call : str
+
+  __test__ = False  # not a pytest test class
+
+  @property
+  def is_import_style(self) -> bool:
+    return self.style == 'import_style'
+
+  def to_string(self) -> str:
+    """Returns the legacy comment-encoded form of the test."""
+    return (f"# signature = {self.signature}\n# indent = '{self.indent}'\n{self.dummy_name} = Dummy()\n"
+            f"# style = '{self.style}'\nx = {self.test_call}\ny = {self.target_call}\n"
+            f"assert x == y, f'Test failure: {{x}} != {{y}}'")
+
+  def __str__(self) -> str:
+    return self.to_string()
+
+  def to_dict(self) -> Dict[str, str]:
+    return asdict(self)
+
+  def to_json(self) -> str:
+    """Returns a compact JSON serialization, e.g. for test case files."""
+    return json.dumps(list(asdict(self).values()), separators=(',', ':'))
+
+  @classmethod
+  def from_dict(cls, data : Dict[str, str]) -> "TestSpec":
+    return cls(**data)
+
+  @classmethod
+  def from_json(cls, data : str) -> "TestSpec":
+    return cls(*json.loads(data))
+
+  @classmethod
+  def from_string(cls, test : str) -> "TestSpec":
+    return _parse_legacy_test(test)
+
+  @classmethod
+  def parse(cls, test : Union["TestSpec", str, Dict[str, str], Any]) -> "TestSpec":
+    """Accepts a TestSpec, its dict or JSON serialization, or the legacy string form."""
+    if isinstance(test, TestSpec): return test
+    if isinstance(test, dict): return cls.from_dict(test)
+    if isinstance(test, str) and test.startswith('['): return cls.from_json(test)
+    return cls.from_string(test)
+
+@functools.lru_cache(maxsize=4096)
+def _parse_legacy_test(test : str) -> TestSpec:
+  fields = {'style': 'import_style'}
+  for line in test.split('\n'):
+    if line.startswith('# signature ='):
+      fields['signature'] = line.split('=', 1)[1].strip()
+    elif line.startswith('# indent ='):
+      fields['indent'] = line.split("'")[1]
+    elif line.startswith('# style ='):
+      fields['style'] = line.split('=', 1)[1].strip().strip("'")
+    elif line.endswith(' = Dummy()'):
+      fields['dummy_name'] = line.split(' ')[0]
+    elif line.startswith('x = '):
+      fields['test_call'] = line[len('x = '):]
+    elif line.startswith('y = '):
+      fields['target_call'] = line[len('y = '):]
+  return TestSpec(**fields)
@@ -0,0 +1,50 @@
+"""Offline token counting for prompt budgets.
+
+Tokenizers are named by a string:
+
+  'approx'              a regex approximation that needs no dependencies.
+  'tiktoken:<encoding>' a tiktoken encoding, e.g. 'tiktoken:p50k_base' (needs
+                        `tiktoken` and its cached encoding files).
+  'hf:<model name>'     a HuggingFace tokenizer (needs `transformers`).
+
+Any `Callable[[str], int]` can be used instead. Counts are cached per text, so
+the pieces of a prompt (one rendered function, one few-shot block) are only
+tokenized once across a suite, and a prompt's length is the sum of the counts
+of its pieces.
+"""
+
+import functools
+import re
+from typing import Callable, Iterable, Union
+
+Tokenizer = Union[str, Callable[[str], int]]
+
+# words split into ~4 character pieces, single digits and symbols, and whitespace runs
+APPROX_PATTERN = re.compile(r"[A-Za-z]+|\d|[^\sA-Za-z\d]|\s+")
+
+def approx_count(text : str) -> int:
+  return sum(1 + (len(piece) - 1) // 4 for piece in APPROX_PATTERN.findall(text))
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(tokenizer : Tokenizer) -> Callable[[str], int]:
+  if callable(tokenizer): return tokenizer
+  if tokenizer == 'approx': return approx_count
+  kind, _, name = tokenizer.partition(':')
+  if kind == 'tiktoken':
+    import tiktoken
+    encoding = tiktoken.get_encoding(name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+  elif kind == 'hf':
+    import transformers
+    hf_tokenizer = transformers.AutoTokenizer.from_pretrained(name)
+    return lambda text: len(hf_tokenizer.encode(text, add_special_tokens=False))
+  raise ValueError(f"Tokenizer {tokenizer} not recognized; use 'approx', 'tiktoken:<encoding>' or 'hf:<model name>'.")
+
+@functools.lru_cache(maxsize=65536)
+def count_tokens(text : str, tokenizer : Tokenizer = 'approx') -> int:
+  return get_tokenizer(tokenizer)(text)
+
+def count_joined(pieces : Iterable[str], joiner : str, tokenizer : Tokenizer = 'approx') -> int:
+  """The token count of `joiner.join(pieces)`, from the cached counts of its pieces."""
+  pieces = list(pieces)
+  return sum(count_tokens(piece, tokenizer) for piece in pieces) + max(len(pieces) - 1, 0) * count_tokens(joiner, tokenizer)
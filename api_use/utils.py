@@ -1,8 +1,8 @@
 from collections import Counter, defaultdict
+import functools
 import random
 import re
-from typing import Any, Callable, Dict, List, Optional, Set, Union
-from typing_extensions import Literal
+from typing import Any, Callable, Dict, List, Literal, Optional, Set, Tuple, Union
 
 from . import task
 
@@ -59,6 +59,25 @@ def format_functions(funcs : List[task.Function],
   out = joiner.join(format_function(func) for func in funcs)
   return out
 
+# Suites usually hold the library fixed and vary the task, so the same pools
+# are rendered over and over. Functions are namedtuples of strings and tuples,
+# so a pool and the formatting options make a complete cache key.
+@functools.lru_cache(maxsize=4096)
+def render_function(func : task.Function,
+                    indent : str,
+                    use_quotes : bool,
+                    no_description : bool = False) -> str:
+  return default_format_function(func, indent=indent, use_quotes=use_quotes, no_description=no_description)
+
+@functools.lru_cache(maxsize=256)
+def render_function_block(funcs : Tuple[task.Function, ...],
+                          indent : str,
+                          use_quotes : bool,
+                          no_description : bool = False,
+                          joiner : str = '\n') -> str:
+  """`format_functions` with the default format function, memoized per pool and per function."""
+  return joiner.join(render_function(func, indent, use_quotes, no_description) for func in funcs)
+
 def deduplicate_unfixed_params(unfixed_params : Dict[str, str]):
   unfixed_params_count = Counter(unfixed_params.values())
   used_so_far : defaultdict[str, int] = defaultdict(int)
@@ -109,7 +128,7 @@ def get_fname_mapping(function_pool : List[task.Function],
   new_definitions = [f.definition for f in function_pool]
   old_arg_to_new_args : List[Optional[Dict[str, str]]] = []
   if arg_noise_type == 'number':
-    new_arglists = [[f"arg{i}" for i in range(len(arglist))] for arglist in new_arglists]
+    new_arglists = [tuple(f"arg{i}" for i in range(len(arglist))) for arglist in new_arglists]
     old_arg_to_new_args = [{o_a: n_a for o_a, n_a in zip(old_arglist, new_arglist)} for old_arglist, new_arglist in zip(arglists, new_arglists)]
   else:
     old_arg_to_new_args = [None] * len(arglists)
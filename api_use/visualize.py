@@ -1,21 +1,33 @@
 from absl import app, flags
-from rich.console import Console
-from rich.padding import Padding
-from rich.panel import Panel
-from rich.text import Text
-from rich import box
-from rich.rule import Rule
-from rich.table import Table
+import fnmatch
+import functools
 import json
+import os
+import re
 import sys
 
 from . import api
 from . import api_use_tasks
+from . import results
+from . import store
 
-flags.DEFINE_string('test_cases_path', '', 'The path to the test cases.')
+flags.DEFINE_string('test_cases_path', '', 'The path to the test cases (JSON, or a materialized .apistore).')
+flags.DEFINE_string('filter', '', 'Only show cases whose id matches this glob (or regex, if prefixed with "re:").')
+flags.DEFINE_integer('page', 1, 'The page of matching cases to show.')
+flags.DEFINE_integer('page_size', 10, 'The number of cases per page.')
+flags.DEFINE_string('results_dir', '', 'An experiment directory whose stored decodes and verdicts are shown with each case.')
+flags.DEFINE_enum('layout', 'side_by_side', ['side_by_side', 'stacked'],
+                  'Whether stored decodes are shown beside each case (needs a ~200 column terminal) or below it.')
 FLAGS = flags.FLAGS
+flags.register_validator('page', lambda page: page >= 1, message='--page must be at least 1.')
+flags.register_validator('page_size', lambda page_size: page_size >= 1, message='--page_size must be at least 1.')
+
+# rich is only imported once something is rendered.
+@functools.lru_cache(maxsize=None)
+def get_console():
+  from rich.console import Console
+  return Console(highlight=False)
 
-console = Console(highlight=False)
 colors = ['red', 'blue', '#fcba03', 'purple']
 captions = {
   'prompt': 'the prompt provided to the model',
@@ -24,21 +36,28 @@ captions = {
   'printable': 'printable args and result'
 }
 
-def render_result(result):
+def result_renderables(result):
+  from rich.panel import Panel
+  renderables = []
   for (key, value), color in zip(result.items(), colors):
     caption = captions[key]
     title = f'[bold {color}]{key.capitalize()}[bold /{color}] ({caption})'
     pd = Panel(value, title=title, width=100, title_align='left')
     if key == 'printable':
-      console.print(title)
-      console.print(value)
-      console.print('')
+      renderables += [title, value, '']
     else:
-      console.print(pd)
+      renderables.append(pd)
+  return renderables
 
 
-def execute(*args, **kwargs):
-  #print(f"Test case args:")
+def render_result(result):
+  for renderable in result_renderables(result):
+    get_console().print(renderable)
+
+
+def args_table(kwargs):
+  from rich import box
+  from rich.table import Table
   table = Table(width=100, box=box.DOUBLE_EDGE, show_header=False, title_justify='left')
 
   table.add_column("key", justify="right", style="bold green", width=20)
@@ -46,49 +65,119 @@ def execute(*args, **kwargs):
 
   for k, v in kwargs.items():
     table.add_row(k, json.dumps(v, indent=2) if isinstance(v, (dict, list)) else str(v))
+  return table
+
+
+def render_args(kwargs):
+  get_console().print(args_table(kwargs))
 
-  #text = '\n'.join(f"[bold]{k:<20}[/bold][italic]{str(v):<30}[/italic]" for k, v in kwargs.items())
-  #pn = Panel(text, title='[bold green]Args[/bold green]', width=100, box=box.DOUBLE_EDGE, title_align='left')
-  #console.print(pn)
-  console.print(table)
-  function_call = 'results = api.get_example(\n' + '\n'.join(f'  {k}={v.__repr__()},' for k, v in kwargs.items()) + '\n)'
-  #pd = Panel(function_call, title=f'[bold purple]Function call[/bold purple]', width=100, title_align='left')
-  #console.print(pd)
-  #console.print(f'[bold purple]Function call[/bold purple]')
-  #print("```python\n" + function_call + "\n```")
+
+def example_renderables(**kwargs):
+  """Generates a case and returns its arguments table and result panels."""
+  table = args_table(kwargs)
   kwargs['return_test_case'] = True
   result = api.get_example(**kwargs)
-  TRIP = '"""'
-  #stripped_fcall = '\n'.join(function_call.split('\n'))
-  result = result.__dict__
-  #result['printable'] = f"```python\n>>> {function_call}\n>>> results.prompt\n{TRIP}{result['prompt']}{TRIP}\n```"
-  render_result(result)
+  return [table] + result_renderables({k: str(v) for k, v in result.__dict__.items()})
+
+
+def execute(*args, **kwargs):
+  for renderable in example_renderables(**kwargs):
+    get_console().print(renderable)
+
+
+def stored_renderables(stored):
+  """The arguments table and result panels of a case from a materialized prompt store, without generating it."""
+  return [args_table(stored.metadata)] + result_renderables({'prompt': stored.prompt, 'target': stored.target, 'test': str(stored.test)})
+
+
+def render_stored(stored):
+  for renderable in stored_renderables(stored):
+    get_console().print(renderable)
+
+
+def decodes_table(case_result):
+  """A run's stored decodes next to their verdicts."""
+  from rich import box
+  from rich.table import Table
+  from rich.text import Text
+  table = Table(width=100, box=box.SIMPLE_HEAD, title_justify='left',
+                title=f'[bold]Decodes[/bold] ({case_result.correct}/{len(case_result.decodes)} correct)')
+  table.add_column("#", justify="right", width=4)
+  table.add_column("verdict", width=9)
+  table.add_column("decode", width=46)
+  table.add_column("error", style="dim", width=33)
+  for i, (decode, (correct, error)) in enumerate(zip(case_result.decodes, case_result.outputs)):
+    verdict = '[bold green]pass[/bold green]' if correct else '[bold red]fail[/bold red]'
+    table.add_row(str(i), verdict, Text(decode), Text(error.strip().split('\n')[-1] if error else ''))
+  return table
+
+
+def render_decodes(case_result):
+  get_console().print(decodes_table(case_result))
+
+
+def render_case(case, decodes=None, layout='side_by_side'):
+  """Prints a case's renderables, with its decodes (if any) beside or below them."""
+  console = get_console()
+  if decodes is None or layout == 'stacked':
+    for renderable in case + ([decodes] if decodes is not None else []):
+      console.print(renderable)
+    return
+  from rich.console import Group
+  from rich.table import Table
+  grid = Table.grid(padding=(0, 2))
+  grid.add_column(width=100)
+  grid.add_column(width=100)
+  grid.add_row(Group(*case), decodes)
+  console.print(grid, width=202)
+
+
+def select_case_ids(case_ids, pattern):
+  """Filters case ids by a glob, or by a regex if the pattern starts with 're:'."""
+  if not pattern: return list(case_ids)
+  if pattern.startswith('re:'):
+    regex = re.compile(pattern[len('re:'):])
+    return [case_id for case_id in case_ids if regex.search(case_id)]
+  return [case_id for case_id in case_ids if fnmatch.fnmatchcase(case_id, pattern)]
 
 
 def main(argv):
+  console = get_console()
   jsonpath = FLAGS.test_cases_path
   if not jsonpath:
       if len(argv) > 1: jsonpath = argv[1]
   assert jsonpath, "Path to json test file must be provided!"
-  
-  with open(jsonpath, 'r') as f:
-    json_file = json.load(f)
-    for case_label, case_data in list(json_file.items()): #[:15]:
-      print()
-      console.print(f"Running {case_label}", style='bold white on blue', justify='center', width=100)
-      execute(**case_data)
-      print()
-
-  def ff(func):
-      args = func.args
-      arglist = ", ".join(args)
-      return f"- The {func.name} function takes the arguments {arglist} and {func.definition.lower()}"
-
-  execute(signature="solids.volume_of_cone()",
-          description="gets the volume of a cone",
-          func_name="get_volume_of_cone",
-                             num_distractors=4,
-                             format_function=ff)
+
+  if jsonpath.endswith('.apistore'):
+    cases = store.PromptStore(jsonpath)
+  else:
+    with open(jsonpath, 'r') as f:
+      cases = json.load(f)
+
+  case_ids = select_case_ids(cases, FLAGS.filter)
+  num_pages = max((len(case_ids) + FLAGS.page_size - 1) // FLAGS.page_size, 1)
+  start = (FLAGS.page - 1) * FLAGS.page_size
+  page = case_ids[start:start + FLAGS.page_size]
+  console.print(f"Showing cases {start + 1}-{start + len(page)} of {len(case_ids)} matching "
+                f"(page {FLAGS.page}/{num_pages})", style='bold', width=100)
+
+  # Only the cases on the requested page are generated and rendered.
+  for case_label in page:
+    print()
+    console.print(f"Running {case_label}", style='bold white on blue', justify='center', width=100)
+    if isinstance(cases, store.PromptStore):
+      case = stored_renderables(cases[case_label])
+    else:
+      case = example_renderables(**cases[case_label])
+    decodes = None
+    if FLAGS.results_dir:
+      if os.path.exists(results.decodes_path(FLAGS.results_dir, case_label)):
+        decodes = decodes_table(results.read_decodes(FLAGS.results_dir, case_label))
+      else:
+        decodes = f"[italic]No stored decodes for {case_label} in {FLAGS.results_dir}.[/italic]"
+    render_case(case, decodes, FLAGS.layout)
+    print()
+
 if __name__ == '__main__':
   app.run(main)
 
@@ -0,0 +1,153 @@
+"""Compares the results of two or more experiment directories.
+
+  python3 diff.py runs/BASELINE runs/CANDIDATE [runs/OTHER ...]
+
+Each run is compared against the first, with cases lined up by test case id
+from each directory's `summary.txt`. The report gives the overall and
+per-group accuracy deltas with a two-proportion z-test, the cases whose
+accuracy changed significantly, the cases solved in only one of the runs
+(flipped), and example decodes of the flipped cases. Groups are named by the
+first capture group of --group_pattern applied to the test case ids (by
+default the leading field, e.g. the chain length in `chaining.json`). With
+many cases, per-case significance is Bonferroni-corrected.
+
+Only the summaries are read in full; decodes are only read for the examples.
+"""
+
+from dataclasses import dataclass
+import os
+import re
+from typing import Dict, List, Tuple
+
+from absl import app
+from absl import flags
+
+from api_use import results
+from api_use import stats
+
+flags.DEFINE_string('group_pattern', r'^([^_]+)_', 'A regex whose first group names the group of a test case id')
+flags.DEFINE_float('alpha', 0.05, 'The significance level, Bonferroni-corrected for per-case changes')
+flags.DEFINE_integer('max_cases', 20, 'The number of changed and flipped cases listed per comparison')
+flags.DEFINE_integer('num_examples', 3, 'The number of flipped cases shown with example decodes')
+flags.DEFINE_string('output_path', '', 'If given, the report is also written here')
+FLAGS = flags.FLAGS
+
+@dataclass
+class Delta:
+  name : str
+  base_correct : int
+  base_total : int
+  correct : int
+  total : int
+
+  @property
+  def base_accuracy(self) -> float:
+    return self.base_correct / max(self.base_total, 1)
+
+  @property
+  def accuracy(self) -> float:
+    return self.correct / max(self.total, 1)
+
+  @property
+  def delta(self) -> float:
+    return self.accuracy - self.base_accuracy
+
+  @property
+  def flipped(self) -> bool:
+    return (self.base_correct > 0) != (self.correct > 0)
+
+  def test(self) -> Tuple[float, float]:
+    return stats.two_proportion_test(self.base_correct, self.base_total, self.correct, self.total)
+
+  def format(self) -> str:
+    z, p = self.test()
+    return (f'{self.name}\t{self.base_correct}/{self.base_total} -> {self.correct}/{self.total}\t'
+            f'{self.base_accuracy:.3f} -> {self.accuracy:.3f} ({self.delta:+.3f})\tz={z:+.2f}\tp={p:.2g}')
+
+def compare(base : Dict[str, results.SummaryRow],
+            other : Dict[str, results.SummaryRow],
+            group_pattern : str) -> Tuple[List[Delta], Dict[str, Delta]]:
+  """Lines up the cases two runs share; returns their deltas and the pooled deltas of each group."""
+  regex = re.compile(group_pattern)
+  cases, groups = [], {}
+  for test_case_id, row in other.items():
+    base_row = base.get(test_case_id)
+    if base_row is None: continue
+    case = Delta(test_case_id, base_row.correct, base_row.total, row.correct, row.total)
+    cases.append(case)
+    match = regex.search(test_case_id)
+    name = (match.group(1) if match.groups() else match.group(0)) if match else '(none)'
+    group = groups.setdefault(name, Delta(name, 0, 0, 0, 0))
+    group.base_correct += case.base_correct
+    group.base_total += case.base_total
+    group.correct += case.correct
+    group.total += case.total
+  return cases, groups
+
+def format_examples(base_dir : str, other_dir : str, test_case_id : str) -> List[str]:
+  """A passing decode from the run that solved a case, and a failing one from the run that did not."""
+  lines = [test_case_id]
+  for label, experiment_dir in (('base', base_dir), ('other', other_dir)):
+    if not os.path.exists(results.decodes_path(experiment_dir, test_case_id)):
+      lines.append(f'  {label}: no stored decodes')
+      continue
+    case = results.read_decodes(experiment_dir, test_case_id)
+    passing = [decode for decode, (correct, _) in zip(case.decodes, case.outputs) if correct]
+    failing = [(decode, error) for decode, (correct, error) in zip(case.decodes, case.outputs) if not correct]
+    if passing:
+      lines.append(f'  {label} passes ({len(passing)}/{len(case.decodes)}): {passing[0]!r}')
+    elif failing:
+      decode, error = failing[0]
+      lines.append(f'  {label} fails ({len(failing)}/{len(case.decodes)}): {decode!r}')
+      if error: lines.append(f'    {error.strip().splitlines()[-1]}')
+  return lines
+
+def diff(base_dir : str, other_dir : str, base : Dict[str, results.SummaryRow], other : Dict[str, results.SummaryRow],
+         group_pattern : str, alpha : float, max_cases : int, num_examples : int) -> List[str]:
+  """The report comparing one run against the baseline."""
+  cases, groups = compare(base, other, group_pattern)
+  overall = Delta('overall', 0, 0, 0, 0)
+  for case in cases:
+    overall.base_correct += case.base_correct
+    overall.base_total += case.base_total
+    overall.correct += case.correct
+    overall.total += case.total
+
+  lines = [results.RULE.rstrip('\n'), f'{base_dir} -> {other_dir}',
+           f'{len(cases)} shared cases; {len(base) - len(cases)} only in the base run, {len(other) - len(cases)} only in the other',
+           overall.format(), '', 'Groups:']
+  lines += ['  ' + group.format() + ('  *' if group.test()[1] < alpha else '') for group in sorted(groups.values(), key=lambda g: g.name)]
+
+  corrected_alpha = alpha / max(len(cases), 1)
+  p_values = [case.test()[1] for case in cases]
+  significant = sorted((case for case, p in zip(cases, p_values) if p < corrected_alpha), key=lambda case: -abs(case.delta))
+  regressions = sum(case.delta < 0 for case in significant)
+  lines += ['', f'Significant changes (p < {corrected_alpha:.2g}): {regressions} regressions, {len(significant) - regressions} improvements']
+  lines += ['  ' + case.format() for case in significant[:max_cases]]
+
+  flipped = sorted((case for case in cases if case.flipped), key=lambda case: case.delta)
+  lost = sum(case.correct == 0 for case in flipped)
+  lines += ['', f'Flipped (solved in only one run): {lost} lost, {len(flipped) - lost} gained']
+  lines += ['  ' + case.format() for case in flipped[:max_cases]]
+
+  if flipped and num_examples:
+    lines += ['', 'Examples:']
+    for case in flipped[:num_examples]:
+      lines += ['  ' + line for line in format_examples(base_dir, other_dir, case.name)]
+  return lines
+
+def main(argv):
+  experiment_dirs = argv[1:]
+  assert len(experiment_dirs) >= 2, "At least two experiment directories must be provided!"
+  summaries = [results.read_summary(experiment_dir) for experiment_dir in experiment_dirs]
+  report = []
+  for experiment_dir, summary in zip(experiment_dirs[1:], summaries[1:]):
+    report += diff(experiment_dirs[0], experiment_dir, summaries[0], summary,
+                   FLAGS.group_pattern, FLAGS.alpha, FLAGS.max_cases, FLAGS.num_examples)
+  print('\n'.join(report))
+  if FLAGS.output_path:
+    with open(FLAGS.output_path, 'w') as f:
+      f.write('\n'.join(report) + '\n')
+
+if __name__ == "__main__":
+  app.run(main)
@@ -1,10 +1,12 @@
-import concurrent.futures
+import collections
+import dataclasses
 from functools import partial
+import hashlib
 import json
 import os
 import random
-import requests
 import string
+import threading
 import time
 
 from absl import app
@@ -12,20 +14,52 @@ from absl import flags
 
 from api_use import api
 from api_use import api_use_tasks
+from api_use import backends
 from api_use import execution
-RULE = '-' * 80 + '\n'
+from api_use import results
+from api_use import sharding
+from api_use import stats
+from api_use import store
+RULE = results.RULE
 
-flags.DEFINE_string('model_type', "codex", 'The model type.')
+flags.DEFINE_string('model_type', "codex", 'The model backend: codex, local, stub, or any other name registered with backends.Backend.register')
 flags.DEFINE_string('rpn', "cushman", 'The name of the model.')
-flags.DEFINE_string('test_cases_path', "", 'The path to the test cases')
+flags.DEFINE_string('test_cases_path', "", 'The path to the test cases (JSON, or a materialized .apistore)')
 flags.DEFINE_string('temperature', "0.5", 'The temperature')
-flags.DEFINE_string('base_path', "." 'The base path')
+flags.DEFINE_string('base_path', ".", 'The base path')
 flags.DEFINE_integer('num_decodes', 128, 'The number of decodes desired')
 flags.DEFINE_integer('max_tokens', 128, 'The maximum number of tokens desired')
 flags.DEFINE_string('openai_key', "", 'The openai key (for codex probing)')
+flags.DEFINE_string('openai_url', 'https://api.openai.com/v1/engines/code-{rpn}-001/completions', 'The completions endpoint, with {rpn} standing for the model name (codex only)')
+flags.DEFINE_integer('pool_size', 10, 'The number of connections kept open to the completions endpoint (codex only)')
+flags.DEFINE_bool('keep_alive', True, 'Reuse connections to the completions endpoint between requests (codex only)')
+flags.DEFINE_float('connect_timeout', 10, 'The timeout for connecting to the completions endpoint, in seconds (codex only)')
+flags.DEFINE_float('read_timeout', 600, 'The timeout for each read from the completions endpoint, in seconds (codex only)')
+flags.DEFINE_bool('http2', False, 'Talk to the completions endpoint over HTTP/2; needs httpx[http2] (codex only)')
+flags.DEFINE_bool('stream', False, 'Stream completions and score each decode as soon as it is complete, instead of once the whole response has arrived')
+flags.DEFINE_integer('stream_batch_size', 8, 'The number of streamed decodes of a prompt scored together (streaming only)')
+flags.DEFINE_float('stream_batch_delay', 0.5, 'The longest a streamed decode waits for the rest of its micro-batch, in seconds (streaming only)')
+flags.DEFINE_string('local_model', "", 'The HuggingFace model to load (local backend only)')
+flags.DEFINE_integer('batch_size', 1, 'The number of test cases whose prompts are sampled in one backend call')
+flags.DEFINE_integer('max_request_decodes', 128, 'The maximum number of decodes packed into one completions request (codex only)')
+flags.DEFINE_integer('max_request_tokens', None, 'The maximum number of prompt plus completion tokens packed into one completions request (codex only)')
+flags.DEFINE_integer('num_scoring_threads', 0, 'The number of threads scoring decodes concurrently with sampling (0 scores inline)')
+flags.DEFINE_bool('adaptive_sampling', False, 'Request decodes in chunks and stop early once the accuracy estimate is tight enough')
+flags.DEFINE_integer('decode_chunk_size', 16, 'The number of decodes requested per chunk (adaptive sampling only)')
+flags.DEFINE_float('target_ci_width', 0.2, 'Stop sampling once the 95% confidence interval on accuracy is narrower than this (adaptive sampling only)')
+flags.DEFINE_integer('max_prompt_tokens', None, 'Drop distractors or few-shot examples from prompts longer than this many tokens')
+flags.DEFINE_string('tokenizer', 'approx', "The offline tokenizer prompts are measured with, for --max_prompt_tokens and --max_request_tokens: approx, tiktoken:<encoding> or hf:<model name>")
+flags.DEFINE_enum('budget_policy', 'distractors_then_shots', ['distractors_then_shots', 'shots_then_distractors', 'drop_distractors', 'drop_shots', 'error'],
+                  'What to drop from prompts over --max_prompt_tokens')
+flags.DEFINE_list('execution_servers', [], 'host:port addresses of execution servers (see api_use.execution_server) to score on')
+flags.DEFINE_list('rpns', [], 'Compare several models (of --model_type) in one run; the model names for local models')
+flags.DEFINE_list('temperatures', [], 'Compare several temperatures in one run')
+flags.DEFINE_integer('num_shards', 1, 'Split the suite into this many shards balanced by estimated cost, and run only one')
+flags.DEFINE_integer('shard_index', 0, 'The shard to run, from 0 to --num_shards - 1')
+flags.DEFINE_list('timings_from', [], 'Experiment directories whose per-case costs refine the cost estimates used for sharding')
 FLAGS = flags.FLAGS
-
-import sys
+flags.register_multi_flags_validator(['stream', 'adaptive_sampling'], lambda values: not (values['stream'] and values['adaptive_sampling']),
+                                     message='--stream cannot be combined with --adaptive_sampling')
 
 USE_GFILE = False
 if USE_GFILE:
@@ -36,96 +70,387 @@ else:
   open_ = open
   mkdirs = partial(os.makedirs, exist_ok=True)
 
-def make_request_openai(prompt,
-                        model_type='davinci',
-                        temperature=0.5):
-  for i in range(3):
-    response = requests.post(f'https://api.openai.com/v1/engines/code-{model_type}-001/completions', json={
-      "prompt": prompt,
-      "stop": "[END]",
-      "max_tokens": FLAGS.max_tokens,
-      "temperature": float(temperature),
-      "n": FLAGS.num_decodes,
-    }, headers={
-      'Authorization': f'Bearer {FLAGS.openai_key}'
-    })
-    if 'is currently overloaded' in response.text or 'Rate limit' in response.text:
-      time.sleep(60*i)
-    else:
-      break
-  assert response.status_code == 200, response.text
-  return [x['text'] for x in response.json()['choices']]
-
 def generate_label():
     random.seed()
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
 
-def sample_from_test_case(test_case, test_case_id, sample_fn):
-  results = api.get_example(**test_case)
-  return test_case_id, sample_fn(results.prompt), results
+# Nothing after the first blank line of a decode is kept, so streamed decodes are complete once they reach it.
+DECODE_END = '\n\n'
 
 def clean_decodes(decodes, cutoff='[END]'):
   out = []
   for result in decodes:
     if cutoff in result:
       result = result[:result.index(cutoff)]
-    result = result.split('\n\n')[0]
+    result = result.split(DECODE_END)[0]
     out.append(result)
   return out
 
-def execute_test_cases(test_cases, sample_fn, experiment_dir, summary_filename, do_threading=False):
-  test_case_id_to_decodes = {}
-  if do_threading:
-    pass
-    # with concurrent.futures.ThreadPoolExecutor() as executor:
-    #   futures = []
-    #   for test_case_id, test_case in test_cases.items():
-    #     futures.append(executor.submit(sample_from_test_case,
-    #                                    test_case=test_case,
-    #                                    test_case_id=test_case_id,
-    #                                    sample_fn=sample_fn))
-    #     print(f"Submitted {test_case_id}")
-    #     time.sleep(5) # avoid smashing openai endpoint
-    #   for (test_case_id, samples, results) in concurrent.futures.as_completed(futures):
-    #     test_case_id_to_decodes[test_case_id] = samples
-  else:
-    outputs = {}
-    for test_case_id, test_case in test_cases.items():
+def execute_decodes(decodes, test, cache=None):
+  """Scores a list of decodes, always returning one (correct, error) pair per decode.
+
+  Each distinct decode is executed once. `cache` maps (test, decode) pairs to
+  their outputs, and may be shared between runs and scoring threads; decodes
+  already in it are not executed again.
+  """
+  if not decodes: return []
+  if cache is None: cache = {}
+  unscored = list(dict.fromkeys(decode for decode in decodes if (test, decode) not in cache))
+  if unscored:
+    execution_outputs = execution.execute(unscored, test)
+    if len(unscored) == 1: execution_outputs = [execution_outputs]
+    for decode, output in zip(unscored, execution_outputs):
+      cache[(test, decode)] = output
+  return [cache[(test, decode)] for decode in decodes]
+
+def write_results(test_case_id, test_case, data, decodes, execution_outputs, latency, experiment_dir, summary_filename, cost=None):
+  correct = sum(output[0] for output in execution_outputs)
+  summary = results.format_summary_line(test_case_id, correct, len(decodes), latency, cost)
+  with open(summary_filename, 'a') as fp:
+    fp.write(f"{summary}\n")
+  print(summary)
+
+  with open(results.decodes_path(experiment_dir, test_case_id), 'w') as decodes_file:
+    decodes_file.write(results.format_decodes(test_case, data.prompt, decodes, execution_outputs, FLAGS.num_decodes))
+
+def plan_sampling(examples, params):
+  """Groups test cases whose prompts and sampling params are byte-identical.
+
+  Returns a dict from the hash of each unique (prompt, params) pair to the ids
+  of the test cases sharing it. Each group is sampled once and its decodes are
+  fanned out to every test case in it.
+  """
+  groups = collections.defaultdict(list)
+  for test_case_id, example in examples.items():
+    key = hashlib.sha1(json.dumps([example.prompt, dataclasses.asdict(params)]).encode()).hexdigest()
+    groups[key].append(test_case_id)
+  return dict(groups)
+
+def write_plan(groups, group_decodes, plan_filename):
+  """Reports how many decodes deduplication saved, and which test cases shared prompts."""
+  num_test_cases = sum(len(test_case_ids) for test_case_ids in groups.values())
+  sampled = sum(len(group_decodes[key]) for key in groups)
+  undeduplicated = sum(len(group_decodes[key]) * len(test_case_ids) for key, test_case_ids in groups.items())
+  saved = undeduplicated - sampled
+  report = (f'{len(groups)} unique prompts for {num_test_cases} test cases; sampled {sampled} decodes '
+            f'instead of {undeduplicated} (saved {saved}, {saved / max(undeduplicated, 1):.1%})')
+  print(report)
+  with open(plan_filename, 'w') as fp:
+    fp.write(report + '\n')
+    for key, test_case_ids in groups.items():
+      if len(test_case_ids) > 1:
+        fp.write(f'{key}\t{",".join(test_case_ids)}\n')
+
+def sample_batch(prompts, backend, params):
+  """Samples `params.n` decodes for every prompt with a single backend call."""
+  keys = list(prompts)
+  decodes = backend.sample([prompts[key] for key in keys], params)
+  return {key: clean_decodes(d) for key, d in zip(keys, decodes)}
+
+def score_group(test_case_ids, examples, decodes, cache=None):
+  """Scores a group's shared decodes against each test case, running each distinct test once."""
+  test_to_outputs = {}
+  execution_outputs = {}
+  for test_case_id in test_case_ids:
+    test = examples[test_case_id].test
+    if test not in test_to_outputs:
+      test_to_outputs[test] = execute_decodes(decodes, test, cache)
+    execution_outputs[test_case_id] = test_to_outputs[test]
+  return execution_outputs
+
+def stream_batch(batch, examples, backend, params, executor=None, cache=None, micro_batch_size=8, micro_batch_delay=0.5):
+  """Samples a batch with `backend.sample_stream`, scoring decodes in micro-batches as they complete.
+
+  A group's completed decodes are scored together once `micro_batch_size` of
+  them are pending, or once the oldest has waited `micro_batch_delay` seconds
+  (checked as decodes arrive), so each flush is one `execute_decodes` call per
+  distinct test. A (test, decode) pair already scored or being scored is not
+  submitted again. Micro-batches are scored in `executor`'s threads if given,
+  so that scoring overlaps with the rest of the stream. Returns the batch's
+  decodes, their execution outputs, the time from the request to the first
+  verdict, and each group's cost: an equal share of the stream's time, plus
+  the time spent scoring the micro-batches it flushed.
+  """
+  if cache is None: cache = {}
+  keys = list(batch)
+  decodes = {key: [] for key in keys}
+  pending = {key: [] for key in keys}
+  pending_since = {}
+  in_flight = {}  # (test, decode) -> the future scoring it
+  verdict_times = []
+  scoring_times = {key: 0.0 for key in keys}
+  lock = threading.Lock()
+  start = time.time()
+
+  def score(key, test, micro_batch):
+    a = time.time()
+    execute_decodes(micro_batch, test, cache)
+    with lock:
+      verdict_times.append(time.time())
+      scoring_times[key] += time.time() - a
+
+  def flush(key):
+    micro_batch = pending[key]
+    pending[key] = []
+    pending_since.pop(key, None)
+    for test in dict.fromkeys(examples[test_case_id].test for test_case_id in batch[key]):
+      unscored = [decode for decode in dict.fromkeys(micro_batch) if (test, decode) not in cache and (test, decode) not in in_flight]
+      if not unscored: continue
+      future = executor.submit(score, key, test, unscored) if executor else None
+      if future is None: score(key, test, unscored)
+      for decode in unscored: in_flight[(test, decode)] = future
+
+  prompts = [examples[batch[key][0]].prompt for key in keys]
+  for i, decode in backend.sample_stream(prompts, params, cutoff=DECODE_END):
+    key = keys[i]
+    decode = clean_decodes([decode])[0]
+    decodes[key].append(decode)
+    pending[key].append(decode)
+    pending_since.setdefault(key, time.time())
+    now = time.time()
+    for other_key in [other_key for other_key, since in pending_since.items()
+                      if len(pending[other_key]) >= micro_batch_size or now - since >= micro_batch_delay]:
+      flush(other_key)
+  for key in keys:
+    if pending[key]: flush(key)
+  sampling_share = (time.time() - start) / len(keys)
+
+  for future in in_flight.values():
+    if future is not None: future.result()
+  execution_outputs = {}
+  for key in keys:
+    for test_case_id in batch[key]:
+      test = examples[test_case_id].test
+      execution_outputs[test_case_id] = [cache[(test, decode)] for decode in decodes[key]]
+  costs = {key: sampling_share + scoring_times[key] for key in keys}
+  return decodes, execution_outputs, (min(verdict_times) - start if verdict_times else time.time() - start), costs
+
+def score_groups(batch, examples, decodes, executor=None, cache=None):
+  """Scores every group in a batch, spreading groups over `executor`'s threads if given.
+
+  Returns the execution outputs of every test case, and the seconds spent scoring each group.
+  """
+  def score(key):
+    a = time.time()
+    return key, score_group(batch[key], examples, decodes[key], cache), time.time() - a
+  execution_outputs, scoring_times = {}, {}
+  for key, group_outputs, seconds in (executor.map(score, batch) if executor else map(score, batch)):
+    execution_outputs.update(group_outputs)
+    scoring_times[key] = seconds
+  return execution_outputs, scoring_times
+
+def sample_adaptively(groups, examples, backend, params, chunk_size, ci_width, executor=None, cache=None):
+  """Samples and scores decodes in chunks of `chunk_size`.
+
+  Each round requests one chunk for every group that is still active, of at
+  most the decodes it still needs, in one backend call per distinct chunk
+  size (usually one). A group stops once the Wilson interval on the accuracy
+  of each of its test cases is narrower than `ci_width`, or once `params.n`
+  decodes have been drawn. Groups are scored in `executor`'s threads if given.
+  Also returns each group's cost: its share of every round's sampling time,
+  plus its scoring time.
+  """
+  decodes = {key: [] for key in groups}
+  costs = {key: 0.0 for key in groups}
+  execution_outputs = {test_case_id: [] for test_case_ids in groups.values() for test_case_id in test_case_ids}
+  active = list(groups)
+  while active:
+    by_size = collections.defaultdict(list)
+    for key in active:
+      by_size[min(chunk_size, params.n - len(decodes[key]))].append(key)
+    chunks, sampling_shares = {}, {}
+    for n, keys in by_size.items():
       a = time.time()
-      _, decodes, data = sample_from_test_case(test_case, test_case_id, sample_fn)
-      latency = time.time() - a
-      decodes = clean_decodes(decodes)
+      chunks.update(sample_batch({key: examples[groups[key][0]].prompt for key in keys}, backend, params.replace(n=n)))
+      sampling_shares.update(dict.fromkeys(keys, (time.time() - a) / len(keys)))
+    chunk_outputs, scoring_times = score_groups({key: groups[key] for key in active}, examples, chunks, executor, cache)
+    still_active = []
+    for key in active:
+      decodes[key] += chunks[key]
+      costs[key] += sampling_shares[key] + scoring_times[key]
+      converged = True
+      for test_case_id in groups[key]:
+        execution_outputs[test_case_id] += chunk_outputs[test_case_id]
+        correct = sum(output[0] for output in execution_outputs[test_case_id])
+        lower, upper = stats.wilson_interval(correct, len(decodes[key]))
+        converged = converged and upper - lower < ci_width
+      if not converged and len(decodes[key]) < params.n:
+        still_active.append(key)
+    active = still_active
+  return decodes, execution_outputs, costs
+
+def execute_test_cases(test_cases, backend, params, experiment_dir, summary_filename, batch_size=1, num_scoring_threads=0, examples=None,
+                       scoring_cache=None):
+  """Samples and scores every test case, writing results to `experiment_dir`.
+
+  With `num_scoring_threads > 0`, each batch is scored in worker threads
+  while the next batch is being sampled. Scoring off the main thread runs
+  each decode in a subprocess worker (see `execution_utils.WorkerPool`).
+  Results are still written in test case order. Pre-generated `examples`
+  (e.g. from a materialized `store.PromptStore`) are used if given, and a
+  `scoring_cache` (see `execute_decodes`) can be shared with other runs.
+  """
+  if scoring_cache is None: scoring_cache = {}
+  outputs = {}
+  if examples is None:
+    examples = api.get_examples(test_cases)
+  groups = plan_sampling(examples, params)
+  group_decodes = {}
+  keys = list(groups)
+  pending = collections.deque()
+
+  def flush(block):
+    while pending and (block or pending[0][-1].done()):
+      batch, decodes, latency, costs, future = pending.popleft()
+      execution_outputs, scoring_times = future.result()
+      for key, test_case_ids in batch.items():
+        # a group's cost is split evenly among its cases, so that every second is counted once
+        cost = (costs[key] + scoring_times.get(key, 0.0)) / len(test_case_ids)
+        for test_case_id in test_case_ids:
+          write_results(test_case_id, test_cases[test_case_id], examples[test_case_id],
+                        decodes[key], execution_outputs[test_case_id], latency,
+                        experiment_dir, summary_filename, cost)
+          outputs[test_case_id] = (decodes[key], execution_outputs[test_case_id], examples[test_case_id])
+
+  import concurrent.futures
+  executor = concurrent.futures.ThreadPoolExecutor(num_scoring_threads) if num_scoring_threads > 0 else None
+  try:
+    for i in range(0, len(keys), batch_size):
+      batch = {key: groups[key] for key in keys[i:i+batch_size]}
+      a = time.time()
+      future = concurrent.futures.Future()
+      if FLAGS.adaptive_sampling:
+        decodes, execution_outputs, costs = sample_adaptively(batch, examples, backend, params,
+                                                       chunk_size=FLAGS.decode_chunk_size,
+                                                       ci_width=FLAGS.target_ci_width,
+                                                       executor=executor,
+                                                       cache=scoring_cache)
+        future.set_result((execution_outputs, {}))
+        latency = time.time() - a
+      elif FLAGS.stream:
+        decodes, execution_outputs, first_verdict, costs = stream_batch(batch, examples, backend, params, executor, scoring_cache,
+                                                                        micro_batch_size=FLAGS.stream_batch_size,
+                                                                        micro_batch_delay=FLAGS.stream_batch_delay)
+        future.set_result((execution_outputs, {}))
+        latency = time.time() - a
+        print(f'First verdict after {first_verdict:.2f}s, all {sum(map(len, decodes.values()))} after {latency:.2f}s')
+      else:
+        decodes = sample_batch({key: examples[test_case_ids[0]].prompt for key, test_case_ids in batch.items()}, backend, params)
+        latency = time.time() - a
+        costs = {key: latency / len(batch) for key in batch}
+        if executor:
+          future = executor.submit(score_groups, batch, examples, decodes, None, scoring_cache)
+        else:
+          future.set_result(score_groups(batch, examples, decodes, cache=scoring_cache))
+      group_decodes.update(decodes)
+      pending.append((batch, decodes, latency, costs, future))
+      flush(block=False)
+      if backend.name == 'codex': time.sleep(5) # avoid smashing openai endpoint
+    flush(block=True)
+  finally:
+    if executor: executor.shutdown()
+  write_plan(groups, group_decodes, os.path.join(experiment_dir, 'plan.txt'))
+  connection_stats = backend.connection_stats()
+  if connection_stats:
+    print('Connections:', json.dumps(connection_stats))
+    with open(os.path.join(experiment_dir, 'connections.json'), 'w') as fp:
+      json.dump(connection_stats, fp, indent=2)
+  return outputs
+
+def get_backend(rpn=None):
+  return backends.Backend.get_backend(FLAGS.model_type, FLAGS, rpn=rpn)
 
-      execution_outputs = execution.execute(decodes, data.test)
+def config_label(rpn, temperature):
+  return f'{rpn}_t{temperature:g}'
 
-      total = len(decodes)
+def run_matrix(test_cases, examples, experiment_dir, configs):
+  """Runs every (model, temperature) configuration over the same prompts.
+
+  Prompts are generated once. Each model samples in its own thread, running
+  its temperatures in turn, and all runs share one scoring cache, so a decode
+  produced by several configurations is executed once. Every configuration is
+  written to its own subdirectory, and the accuracies are joined in
+  `matrix.txt`.
+  """
+  if examples is None:
+    examples = api.get_examples(test_cases)
+  scoring_cache = {}
+  temperatures = collections.defaultdict(list)
+  for rpn, temperature in configs:
+    temperatures[rpn].append(temperature)
+
+  def run_model(rpn):
+    backend = get_backend(rpn)
+    model_outputs = {}
+    for temperature in temperatures[rpn]:
+      config_dir = os.path.join(experiment_dir, config_label(rpn, temperature)) + '/'
+      mkdirs(config_dir)
+      params = backends.SamplingParams(n=FLAGS.num_decodes, temperature=temperature, max_tokens=FLAGS.max_tokens)
+      model_outputs[(rpn, temperature)] = execute_test_cases(test_cases, backend, params, config_dir,
+                                                             os.path.join(config_dir, 'summary.txt'),
+                                                             batch_size=FLAGS.batch_size,
+                                                             num_scoring_threads=FLAGS.num_scoring_threads,
+                                                             examples=examples,
+                                                             scoring_cache=scoring_cache)
+    return model_outputs
+
+  import concurrent.futures
+  outputs = {}
+  with concurrent.futures.ThreadPoolExecutor(len(temperatures)) as executor:
+    for model_outputs in executor.map(run_model, temperatures):
+      outputs.update(model_outputs)
+  write_matrix(test_cases, {config: outputs[config] for config in configs}, scoring_cache,
+               os.path.join(experiment_dir, 'matrix.txt'))
+  return outputs
+
+def write_matrix(test_cases, outputs, scoring_cache, matrix_filename):
+  """Writes one row of accuracies per test case and one column per configuration."""
+  labels = [config_label(*config) for config in outputs]
+  lines = ['test_case_id\t' + '\t'.join(labels)]
+  totals = {config: [0, 0] for config in outputs}
+  for test_case_id in test_cases:
+    row = []
+    for config, config_outputs in outputs.items():
+      _, execution_outputs, _ = config_outputs[test_case_id]
       correct = sum(output[0] for output in execution_outputs)
-      accuracy = correct / total
-      summary = f'{test_case_id}\t{accuracy:.3f}\t{correct}/{total}\t{latency:.4f}s'
-      with open(summary_filename, 'a') as fp:
-        fp.write(f"{summary}\n")
-      print(summary)
-
-      decodes_file = os.path.join(experiment_dir, test_case_id + '.decodes')
-      with open(decodes_file, 'w') as decodes_file:
-        decodes_file.write(json.dumps(test_case, indent=2) + '\n')
-        decodes_file.write("Prompt: " + data.prompt + '\n')
-        for (decode, result) in zip(decodes, execution_outputs):
-          decodes_file.write(RULE)
-          decodes_file.write('Correct: ' + str(result[0]) + '\n')
-          decodes_file.write('Error: ' + str(result[1]) + '\n')
-          decodes_file.write(RULE)
-          decodes_file.write(str(decode) + '\n')
-          decodes_file.write(RULE)
-
-      outputs[test_case_id] = (decodes, execution_outputs, data)
-      if FLAGS.model_type == 'codex': time.sleep(5) # avoid smashing openai endpoint
-    return outputs
+      totals[config][0] += correct
+      totals[config][1] += len(execution_outputs)
+      row.append(f'{correct / max(len(execution_outputs), 1):.3f}')
+    lines.append(test_case_id + '\t' + '\t'.join(row))
+  lines.append('overall\t' + '\t'.join(f'{correct / max(total, 1):.3f}' for correct, total in totals.values()))
+  num_scored = sum(total for _, total in totals.values())
+  lines.append(f'# scored {len(scoring_cache)} distinct (test, decode) pairs for {num_scored} decodes')
+  with open(matrix_filename, 'w') as fp:
+    fp.write('\n'.join(lines) + '\n')
+  print('\n'.join(lines))
 
-def main(argv):
-  model_type = FLAGS.model_type
-  rpn = FLAGS.rpn
+def select_shard(test_cases, examples, experiment_dir):
+  """Keeps the cases of shard --shard_index out of --num_shards (see `sharding`), in their original order."""
+  features = {test_case_id: sharding.case_features(test_case, FLAGS.num_decodes,
+                                                   examples[test_case_id].prompt if examples else None)
+              for test_case_id, test_case in test_cases.items()}
+  samples = []
+  for timings_dir in FLAGS.timings_from:
+    for test_case_id, row in results.read_summary(timings_dir).items():
+      # only per-case costs are fit: the latency column is per batch and excludes scoring
+      if test_case_id in features and row.cost is not None:
+        samples.append((dataclasses.replace(features[test_case_id], decodes=row.total), row.cost))
+  model = sharding.fit_cost_model(samples)
+  costs = {test_case_id: model.cost(case_features) for test_case_id, case_features in features.items()}
+  shards = sharding.assign_shards(costs, FLAGS.num_shards)
 
+  with open(os.path.join(experiment_dir, 'shard.txt'), 'w') as fp:
+    fp.write(f'shard {FLAGS.shard_index} of {FLAGS.num_shards}; cost model fit on {len(samples)} timings: '
+             f'weights {dict(zip(sharding.FEATURES, model.weights))}, library scales {model.library_scales}\n')
+    for i, shard in enumerate(shards):
+      fp.write(f'{i}\t{len(shard)} cases\t{sum(costs[test_case_id] for test_case_id in shard):.4g} estimated\n')
+  shard = set(shards[FLAGS.shard_index])
+  test_cases = {test_case_id: test_case for test_case_id, test_case in test_cases.items() if test_case_id in shard}
+  if examples is not None:
+    examples = {test_case_id: example for test_case_id, example in examples.items() if test_case_id in shard}
+  return test_cases, examples
+
+def main(argv):
   test_cases_path = FLAGS.test_cases_path
   if not test_cases_path and len(argv) > 1:
       test_cases_path = argv[1]
@@ -136,16 +461,41 @@ def main(argv):
   print("Experiment outputs:", experiment_dir)
   mkdirs(experiment_dir)
 
-  if model_type == 'codex':
-    sample_fn = lambda prompt: make_request_openai(prompt=prompt, temperature=FLAGS.temperature)
+  if FLAGS.execution_servers: execution.SERVERS = FLAGS.execution_servers
+  backend = get_backend()
+  params = backends.SamplingParams(n=FLAGS.num_decodes,
+                                   temperature=float(FLAGS.temperature),
+                                   max_tokens=FLAGS.max_tokens)
+
+  examples = None
+  if test_cases_path.endswith('.apistore'):
+    assert FLAGS.max_prompt_tokens is None, ("Prompts in a store are already materialized; pass --max_prompt_tokens (and --tokenizer, --budget_policy) "
+                                             "to `python -m api_use.store materialize` instead.")
+    prompt_store = store.PromptStore(test_cases_path)
+    examples = {test_case_id: prompt_store[test_case_id] for test_case_id in prompt_store}
+    data = {test_case_id: example.metadata for test_case_id, example in examples.items()}
   else:
-    assert False, "Model type not recognized"
+    with open(test_cases_path, 'r') as f:
+      data = json.load(f)
+    if FLAGS.max_prompt_tokens is not None:
+      budget = {'max_prompt_tokens': FLAGS.max_prompt_tokens, 'tokenizer': FLAGS.tokenizer, 'budget_policy': FLAGS.budget_policy}
+      data = {test_case_id: {**test_case, **budget} for test_case_id, test_case in data.items()}
+
+  if FLAGS.num_shards > 1:
+    assert 0 <= FLAGS.shard_index < FLAGS.num_shards, "--shard_index must be between 0 and --num_shards - 1"
+    data, examples = select_shard(data, examples, experiment_dir)
 
-  with open(test_cases_path, 'r') as f:
-    data = json.load(f)
+  if FLAGS.rpns or FLAGS.temperatures:
+    configs = [(rpn, float(temperature))
+               for rpn in (FLAGS.rpns or [FLAGS.local_model if FLAGS.model_type == 'local' else FLAGS.rpn])
+               for temperature in (FLAGS.temperatures or [FLAGS.temperature])]
+    run_matrix(data, examples, experiment_dir, configs)
+    return
 
   summary_filename = os.path.join(experiment_dir, 'summary.txt')
-  execute_test_cases(data, sample_fn, experiment_dir, summary_filename)
+  execute_test_cases(data, backend, params, experiment_dir, summary_filename,
+                     batch_size=FLAGS.batch_size, num_scoring_threads=FLAGS.num_scoring_threads,
+                     examples=examples)
 
 if __name__ == "__main__":
   app.run(main)
@@ -1,5 +1,6 @@
 from itertools import permutations
 import json
+from api_use import incremental
 from api_use import utils
 
 output = {}
@@ -80,5 +81,4 @@ for key, iid_template in data.items():
   )
 
 print(f"argument_fixing.json: generated {len(output)} examples.")
-with open('testcases/argument_fixing.json', 'w') as f:
-  json.dump(output, f, indent=2)
+incremental.write_test_cases('testcases/argument_fixing.json', output)
@@ -3,6 +3,8 @@ import json
 import random
 #import utils
 
+from api_use import incremental
+
 output = {}
 
 RANDOM_SEEDS = list(range(20))
@@ -62,5 +64,4 @@ for random_seed in RANDOM_SEEDS:
 
 
 print(f"chaining.json: generated {len(output)} examples.")
-with open('testcases/chaining.json', 'w') as f:
-  json.dump(output, f, indent=2)
+incremental.write_test_cases('testcases/chaining.json', output)
@@ -1,6 +1,8 @@
 from itertools import permutations
 import json
 
+from api_use import incremental
+
 # distractors_and_positioning.json
 
 output = {}
@@ -19,5 +21,4 @@ for target_library in ['solids']:
         }
 
 print(f"distractors_and_positioning.json: generated {len(output)} examples.")
-with open('testcases/distractors_and_positioning.json', 'w') as f:
-  json.dump(output, f, indent=2)
+incremental.write_test_cases('testcases/distractors_and_positioning.json', output)
@@ -2,6 +2,7 @@ from itertools import permutations, product
 import json
 import random
 
+from api_use import incremental
 from api_use import utils
 
 output = {}
@@ -84,5 +85,4 @@ for obj in ['cone']:
         }
 
 print(f"name_description.json: generated {len(data)} examples.")
-with open('testcases/name_description.json', 'w') as f:
-  json.dump(data, f, indent=2)
+incremental.write_test_cases('testcases/name_description.json', data)
@@ -0,0 +1,89 @@
+"""Re-scores the decodes stored in an experiment directory, without calling a model.
+
+  python3 replay.py --experiment_dir runs/ABC123 [--test_cases_path testcases/chaining.json]
+
+The tests are regenerated from the test case arguments stored with each
+case's decodes (or from --test_cases_path, which may be a materialized
+.apistore), so a replay picks up any change to test generation or scoring.
+Results go to a new `replay-<label>` directory inside the experiment
+directory, in the same format as the original run, together with a
+`replay.txt` report comparing the two.
+"""
+
+import concurrent.futures
+import json
+import os
+import time
+
+from absl import app
+from absl import flags
+
+import evaluate
+from api_use import api
+from api_use import api_use_tasks
+from api_use import execution
+from api_use import results
+from api_use import store
+
+flags.DEFINE_string('experiment_dir', '', 'The experiment directory whose decodes are re-scored.')
+FLAGS = flags.FLAGS
+
+def load_tests(case_results, test_cases_path):
+  """Returns the current test of every stored case."""
+  if test_cases_path.endswith('.apistore'):
+    prompt_store = store.PromptStore(test_cases_path)
+    return {case.test_case_id: prompt_store[case.test_case_id].test for case in case_results}
+  if test_cases_path:
+    with open(test_cases_path) as f:
+      test_cases = json.load(f)
+    test_cases = {case.test_case_id: test_cases[case.test_case_id] for case in case_results}
+  else:
+    test_cases = {case.test_case_id: case.test_case for case in case_results}
+  return {test_case_id: example.test for test_case_id, example in api.get_examples(test_cases).items()}
+
+def replay(experiment_dir, test_cases_path='', num_threads=8):
+  """Re-scores every stored case in parallel and writes the results to a new directory."""
+  case_results = list(results.iter_decodes(experiment_dir))
+  tests = load_tests(case_results, test_cases_path)
+  replay_dir = os.path.join(experiment_dir, 'replay-' + evaluate.generate_label()) + '/'
+  evaluate.mkdirs(replay_dir)
+  print("Replay outputs:", replay_dir)
+
+  def rescore(case):
+    decodes = case.decodes
+    a = time.time()
+    return decodes, evaluate.execute_decodes(decodes, tests[case.test_case_id], scoring_cache), time.time() - a
+
+  scoring_cache = {}
+  num_flipped, old_correct, new_correct, total = 0, 0, 0, 0
+  flipped_cases = []
+  with concurrent.futures.ThreadPoolExecutor(max(num_threads, 1)) as executor, \
+       open(os.path.join(replay_dir, 'summary.txt'), 'w') as summary_file:
+    for case, (decodes, outputs, latency) in zip(case_results, executor.map(rescore, case_results)):
+      correct = sum(output[0] for output in outputs)
+      summary_file.write(results.format_summary_line(case.test_case_id, correct, len(decodes), latency) + '\n')
+      with open(results.decodes_path(replay_dir, case.test_case_id), 'w') as f:
+        f.write(results.format_decodes(case.test_case, case.prompt, decodes, outputs, case.num_requested or len(decodes)))
+      flips = sum(old[0] != new[0] for old, new in zip(case.outputs, outputs))
+      if flips: flipped_cases.append(f'{case.test_case_id}\t{case.correct}/{len(case.decodes)} -> {correct}/{len(decodes)}')
+      num_flipped += flips
+      old_correct += case.correct
+      new_correct += correct
+      total += len(decodes)
+
+  report = [f'Replayed {len(case_results)} cases ({total} decodes) from {experiment_dir}',
+            f'accuracy {old_correct / max(total, 1):.3f} -> {new_correct / max(total, 1):.3f}; '
+            f'{num_flipped} verdicts flipped in {len(flipped_cases)} cases'] + flipped_cases
+  with open(os.path.join(replay_dir, 'replay.txt'), 'w') as f:
+    f.write('\n'.join(report) + '\n')
+  print('\n'.join(report[:2]))
+  return replay_dir
+
+def main(argv):
+  experiment_dir = FLAGS.experiment_dir or (argv[1] if len(argv) > 1 else '')
+  assert experiment_dir, "An experiment directory must be provided!"
+  if FLAGS.execution_servers: execution.SERVERS = FLAGS.execution_servers
+  replay(experiment_dir, FLAGS.test_cases_path, num_threads=FLAGS.num_scoring_threads or os.cpu_count() or 1)
+
+if __name__ == "__main__":
+  app.run(main)